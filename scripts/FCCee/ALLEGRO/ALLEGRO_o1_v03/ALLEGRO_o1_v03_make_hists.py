@@ -1,113 +1,30 @@
 import argparse
-import ROOT
-from podio import root_io
+import os
+import sys
 
+# The histogram engine is shared by all the FCCee detectors
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "utils"))
+from hist_engine import BACKENDS, load_spec, make_hists_file  # noqa: E402
 
-def make_hist_file(args):
-    print(f'INFO: Input EDM4hep file: {args.inputFile}')
-    print(f'INFO: Output histogram file: {args.outputFile}')
-
-    # create output ROOT file
-    outputFile = ROOT.TFile(args.outputFile, "RECREATE")
-
-    # set file reader
-    podio_reader = root_io.Reader(args.inputFile)
-
-    # set list of directories in ROOT file (one per subsystem to check)
-    dir_list = []
-    # set list of (list of) histograms created (one list per subsystem to check)
-    histo_list = []
-
-    dir_ECalBarrel = outputFile.mkdir("ECalBarrel")
-
-    hist_ccE = ROOT.TH1F(
-        "h_CaloCluster_E",
-        "CaloCluster Energy;Energy [MeV];Counts / 0.15 MeV",
-        100,
-        0,
-        15,
-    )
-    hist_ctcE = ROOT.TH1F(
-        "h_CaloTopoCluster_E",
-        "CaloTopoCluster Energy;Energy [MeV];Counts / 0.15 MeV",
-        100,
-        0,
-        15,
-    )
-    hist_ecal_totE = ROOT.TH1F(
-        "h_ECalBarrelModuleThetaMergedPositioned_totE",
-        "ECalBarrelModuleThetaMergedPositioned total Energy per evt;Energy [MeV];"
-        "Counts / 0.15 MeV",
-        100,
-        0,
-        15,
-    )
-    hist_ecal_posX = ROOT.TH1F(
-        "h_ECalBarrelModuleThetaMergedPositioned_posX",
-        "ECalBarrelModuleThetaMergedPositioned position X;X [mm];Counts / 37 mm",
-        150,
-        -2770,
-        2770,
-    )
-    hist_ecal_posY = ROOT.TH1F(
-        "h_ECalBarrelModuleThetaMergedPositioned_posY",
-        "ECalBarrelModuleThetaMergedPositioned position Y;Y [mm];Counts / 37 mm",
-        150,
-        -2770,
-        2770,
-    )
-    hist_ecal_posZ = ROOT.TH1F(
-        "h_ECalBarrelModuleThetaMergedPositioned_posZ",
-        "ECalBarrelModuleThetaMergedPositioned position Z;Z [mm];Counts / 41 mm",
-        150,
-        -3100,
-        3100,
-    )
-
-    dir_list.append(dir_ECalBarrel)
-    histo_list.append(
-        [
-            hist_ccE,
-            hist_ctcE,
-            hist_ecal_totE,
-            hist_ecal_posX,
-            hist_ecal_posY,
-            hist_ecal_posZ,
-        ]
-    )
-
-    # Loop over dataset
-    for event in podio_reader.get("events"):
+# Histograms to make, see utils/hist_engine.py for the format
+SPEC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ALLEGRO_o1_v03_hists.yaml")
 
-        for calo in event.get("CaloClusterCells"):
-            hist_ccE.Fill(calo.getEnergy())
 
-        for calo in event.get("CaloTopoClusterCells"):
-            hist_ctcE.Fill(calo.getEnergy())
+def metadata_file(args):
+    """
+    metadata.yaml where the resources used are recorded, by default the one
+    of the version, next to the output file
+    """
+    return args.metadata or os.path.join(os.path.dirname(os.path.abspath(args.outputFile)), "metadata.yaml")
 
-        energy = 0
-        for ecal in event.get("ECalBarrelModuleThetaMergedPositioned"):
-            energy += ecal.getEnergy()
-            hist_ecal_posX.Fill(ecal.getPosition().x)
-            hist_ecal_posY.Fill(ecal.getPosition().y)
-            hist_ecal_posZ.Fill(ecal.getPosition().z)
-        hist_ecal_totE.Fill(energy)
 
-    # normalize if desired
-    if args.norm:
-        n_evts = len(podio_reader.get("events"))
-        factor = 1.0 / n_evts
-        for l in histo_list:
-            for h in l:
-                h.Scale(factor)
-
-    # save to file
-    for dir, h_list in zip(dir_list, histo_list):
-        dir.cd()
-        for h in h_list:
-            h.Write()
+def make_hist_file(args):
+    print(f'INFO: Input EDM4hep file: {args.inputFile}')
+    print(f'INFO: Output histogram file: {args.outputFile}')
 
-    outputFile.Close()
+    make_hists_file(load_spec(args.spec), args.inputFile, args.outputFile, args.norm,
+                    backend=args.backend, threads=args.threads, jobs=args.jobs,
+                    metadata=metadata_file(args), task="ALLEGRO_make_hists")
 
 
 # #############################################################################
@@ -130,6 +47,37 @@ def main():
         help="The name of the ROOT file where to save output histograms",
         default="results.root",
     )
+    parser.add_argument(
+        "--spec",
+        type=str,
+        help="YAML file describing the histograms to make",
+        default=SPEC_FILE,
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        help="How to fill the histograms: uproot columns or RDataFrame event loop",
+        default="uproot",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Number of threads of the RDataFrame event loop, 0 uses all the cores and 1 disables multithreading",
+        default=0,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of processes filling the histograms, each one with a share of the events (uses the uproot backend)",
+        default=1,
+    )
+    parser.add_argument(
+        "--metadata",
+        type=str,
+        help="metadata.yaml where the resources used are recorded (default: next to the output file)",
+        default=None,
+    )
     parser.add_argument(
         "--norm",
         action="store_true",
@@ -1,98 +1,28 @@
+import argparse
 import os
 import sys
-import argparse
-import ROOT
-from podio import root_io
-import numpy as np
-from dd4hep import Detector
-import DDRec
-
-
-def make_hists_file(args):
-
-    # create output ROOT file
-    outputFile = ROOT.TFile(args.outputFile, "UPDATE")
-
-    # set file reader
-    podio_reader = root_io.Reader(args.inputFile)
-
-    # get detector description for cell id decoding
-    theDetector = Detector.getInstance()
-    theDetector.fromXML(args.compactFile)
-    idposConv = DDRec.CellIDPositionConverter(theDetector)
-
-    # set list of directories in ROOT file (one per subsystem to check)
-    dir_list = []
-    # set list of (list of) histograms created (one list per subsystem to check)
-    histo_list = []
-
-    dir_ARC = outputFile.mkdir("ARC_standalone")
-
-    hist_ARC_nPh = ROOT.TH1F(
-        "h_ARC_nPh",
-        "Total number of photon counts per event;Number of Photons;"
-        "Photon count / 5",
-        50,
-        0,
-        250,
-    )
-    # TODO: Disabling the plot because the conversion from cellID to position
-    # causes seg-faults
-    # hist_ARC_theta = ROOT.TH1F(
-    #     "h_ARC_theta",
-    #     "Photons counts vs. #theta;Polar angle #theta;Photon count / 35 mrad",
-    #     90,
-    #     0,
-    #     np.pi,
-    # )
-    hist_ARC_1stHit = ROOT.TH1F(
-        "h_ARC_1stHit",
-        "Photons counts vs. #theta of incoming particle;Polar angle #theta;Photon count / 35 mrad",
-        90,
-        0,
-        np.pi,
-    )
 
-    dir_list.append(dir_ARC)
-    # histo_list.append([hist_ARC_nPh, hist_ARC_theta, hist_ARC_1stHit])
-    histo_list.append([hist_ARC_nPh, hist_ARC_1stHit])
+# The histogram engine is shared by all the FCCee detectors
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "utils"))
+from hist_engine import load_spec, make_hists_file  # noqa: E402
 
-    # loop over dataset
-    for event in podio_reader.get("events"):
+# Histograms to make, see utils/hist_engine.py for the format
+SPEC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ARC_hists.yaml")
 
-        n_ph = 0
 
-        p = (event.get("MCParticles"))[0]
-        mom = ROOT.TVector3(p.getMomentum().x,
-                            p.getMomentum().y,
-                            p.getMomentum().z)
-        theta_1stHit = mom.Theta()
+def metadata_file(args):
+    """
+    metadata.yaml where the resources used are recorded, by default the one
+    of the version, next to the output file
+    """
+    return args.metadata or os.path.join(os.path.dirname(os.path.abspath(args.outputFile)), "metadata.yaml")
 
-        for arc_hit in event.get("ArcCollection"):
-            particle = arc_hit.getParticle()
-            pdgID = particle.getPDG()
-            if pdgID in (22, -22):
-                n_ph += 1
-                # cellID = arc_hit.getCellID()
-                # hist_ARC_theta.Fill(idposConv.position(cellID).theta())
 
-        hist_ARC_nPh.Fill(n_ph)
-        hist_ARC_1stHit.Fill(theta_1stHit, n_ph)
+def make_hists_file_ARC(args):
 
-    if args.norm:
-        n_evts = len(podio_reader.get("events"))
-        factor = 1.0 / n_evts
-        for l in histo_list:
-            for h in l:
-                h.Scale(factor)
-
-    # save to file
-    for directory, h_list in zip(dir_list, histo_list):
-        directory.cd()
-        for h in h_list:
-            h.Write()
-
-    outputFile.Close()
+    # the histograms are added to the output file
+    make_hists_file(load_spec(args.spec), args.inputFile, args.outputFile, args.norm, mode="UPDATE",
+                    jobs=args.jobs, metadata=metadata_file(args), task="ARC_make_hists")
 
 
 # #############################################################################
@@ -122,6 +52,25 @@ def main():
         default=None,
         help="Compact file describing the sub-detector",
     )
+    parser.add_argument(
+        "--spec",
+        type=str,
+        help="YAML file describing the histograms to make",
+        default=SPEC_FILE,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of processes filling the histograms, each one with a share of the events",
+        default=1,
+    )
+    parser.add_argument(
+        "--metadata",
+        type=str,
+        help="metadata.yaml where the resources used are recorded (default: next to the output file)",
+        default=None,
+    )
     parser.add_argument(
         "--norm",
         action="store_true",
@@ -134,7 +83,7 @@ def main():
         print('       Aborting...')
         sys.exit(1)
 
-    make_hists_file(args)
+    make_hists_file_ARC(args)
 
 
 if __name__ == "__main__":
@@ -1,127 +1,26 @@
 import argparse
-import ROOT
-from podio import root_io
+import os
+import sys
 
+# The histogram engine is shared by all the FCCee detectors
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "utils"))
+from hist_engine import load_spec, make_hists_file  # noqa: E402
 
+# Histograms to make, see utils/hist_engine.py for the format
+SPEC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "IDEA_o1_v03_hists.yaml")
 
-def make_TH1_file(args):
-
-    # create output ROOT file
-    outputFile = ROOT.TFile(args.outputFile, "RECREATE")
-
-    # set file reader
-    podio_reader = root_io.Reader(args.inputFile)
-
-    # set list of directories in ROOT file (one per subsystem to check)
-    dir_list = []
-    # set list of (list of) histograms created (one list per subsystem to check)
-    histo_list = []
-
-    # Drift Chamber Histograms
-
-    dir_DCH = outputFile.mkdir("DriftChamber")
-
-    hist_dch_hits = ROOT.TH1F(
-        "h_DriftChamber_hits", "Number of hits;Hits;Counts / 5 hits", 40, 0, 200
-    )
-
-    dir_list.append(dir_DCH)
-    histo_list.append([hist_dch_hits])
-
-    # Vertex Barrel Histograms
-
-    dir_VTXB = outputFile.mkdir("VertexBarrel")
-
-    hist_vtxb_hits = ROOT.TH1F(
-        "h_VertexBarrel_hits", "Number of hits;Hits;Counts / 5 hits", 40, 0, 200
-    )
-
-    dir_list.append(dir_VTXB)
-    histo_list.append([hist_vtxb_hits])
-
-    # Vertex Endcap Histograms
-
-    dir_VTXE = outputFile.mkdir("VertexEndcap")
-
-    hist_vtxe_hits = ROOT.TH1F(
-        "h_VertexEndcap_hits", "Number of hits;Hits;Counts / 5 hits", 40, 0, 200
-    )
-
-    dir_list.append(dir_VTXE)
-    histo_list.append([hist_vtxe_hits])
-
-    # Muon System Histograms
-
-    dir_MUS = outputFile.mkdir("MuonSystem")
-
-    hist_mus_hits = ROOT.TH1F(
-        "h_MuonSystem_hits", "Number of hits;Hits;Counts / 5 hits", 40, 0, 200
-    )
 
-    dir_list.append(dir_MUS)
-    histo_list.append([hist_mus_hits])
+def metadata_file(args):
+    """
+    metadata.yaml where the resources used are recorded, by default the one
+    of the version, next to the output file
+    """
+    return args.metadata or os.path.join(os.path.dirname(os.path.abspath(args.outputFile)), "metadata.yaml")
 
-    # LumiCal Histograms
 
-    dir_LC = outputFile.mkdir("LumiCal")
-
-    hist_lc_hits = ROOT.TH1F(
-        "h_LumiCal_hits", "Number of hits;Hits;Counts / 5 hits", 40, 0, 200
-    )
-
-    dir_list.append(dir_LC)
-    histo_list.append([hist_lc_hits])
-
-    # Loop over dataset
-    for event in podio_reader.get("events"):
-
-        # Drift Chamber Event Loop
-        n_hits = 0
-        for dch_hit in event.get("DCHCollection"):
-            n_hits += 1
-        hist_dch_hits.Fill(n_hits)
-
-        # Vertex Barrel Event Loop
-        n_hits = 0
-        for vtxb_hit in event.get("VertexBarrelCollection"):
-            n_hits += 1
-        hist_vtxb_hits.Fill(n_hits)
-
-        # Vertex Endcap Event Loop
-        n_hits = 0
-        for vtxe_hit in event.get("VertexEndcapCollection"):
-            n_hits += 1
-        hist_vtxe_hits.Fill(n_hits)
-
-        # Muon System Event Loop
-        n_hits = 0
-        for mus_hit in event.get("MuonSystemCollection"):
-            n_hits += 1
-        hist_mus_hits.Fill(n_hits)
-
-        # LumiCal Event Loop
-        n_hits = 0
-        for lc_hit in event.get("LumiCalCollection"):
-            n_hits += 1
-        hist_lc_hits.Fill(n_hits)
-
-    # normalize if desired
-    if args.norm:
-        n_evts = len(podio_reader.get("events"))
-        factor = 1.0 / n_evts
-        for l in histo_list:
-            for h in l:
-                h.Scale(factor)
-
-    # save to file
-    for directory, h_list in zip(dir_list, histo_list):
-        directory.cd()
-        for h in h_list:
-            h.Write()
-
-    outputFile.Close()
-
-    return
+def make_TH1_file(args):
+    make_hists_file(load_spec(args.spec), args.inputFile, args.outputFile, args.norm, jobs=args.jobs,
+                    metadata=metadata_file(args), task="IDEA_make_hists")
 
 
 #########################################################################
@@ -145,6 +44,25 @@ def main():
         help="The name of the ROOT file where to save output histograms",
         default="results.root",
     )
+    parser.add_argument(
+        "--spec",
+        type=str,
+        help="YAML file describing the histograms to make",
+        default=SPEC_FILE,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of processes filling the histograms, each one with a share of the events",
+        default=1,
+    )
+    parser.add_argument(
+        "--metadata",
+        type=str,
+        help="metadata.yaml where the resources used are recorded (default: next to the output file)",
+        default=None,
+    )
     parser.add_argument(
         "--norm",
         action="store_true",
@@ -1,4 +1,6 @@
 import argparse
+import sys
+
 import ROOT
 
 
@@ -72,6 +74,37 @@ def compare_histos(histo1, histo2, SL, test_name):
     return match
 
 
+def get_histos(directory, path=""):
+    """
+    All the histograms of a ROOT directory and its subdirectories, by path
+    """
+    histos = {}
+    for key in directory.GetListOfKeys():
+        obj = key.ReadObj()
+        name = f"{path}{key.GetName()}"
+        if obj.InheritsFrom("TDirectory"):
+            histos.update(get_histos(obj, f"{name}/"))
+        elif obj.InheritsFrom("TH1"):
+            histos[name] = obj
+    return histos
+
+
+def compare_files(input_file, ref_file, SL, test_name):
+    """
+    Compare all the histograms of two files, matched by path. Returns
+    whether both files have the same histograms and all of them match
+    """
+    histos = get_histos(input_file)
+    ref_histos = get_histos(ref_file)
+    match = True
+    for name in sorted(set(histos) ^ set(ref_histos)):
+        print(f"Histogram {name} is only in one of the files")
+        match = False
+    for name in sorted(set(histos) & set(ref_histos)):
+        match = compare_histos(histos[name], ref_histos[name], SL, test_name) and match
+    return match
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(
@@ -92,7 +125,10 @@ if __name__ == "__main__":
         default="",
     )
     parser.add_argument(
-        "-h", "--histo", type=str, help="The name of the histogram to check", default=""
+        "--histo",
+        type=str,
+        help="The name of the histogram to check, all of them if not given",
+        default="",
     )
     parser.add_argument(
         "--SL",
@@ -110,8 +146,11 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     input_file = ROOT.TFile(args.inputFile, "READ")
-    ref_file = ROOT.TFile(args.refFile, "READ")
-    histo1 = input_file.Get(args.histo)
-    histo2 = ref_file.Get(args.histo)
-
-    compare_histos(histo1, histo2, args.SL, args.test)
+    ref_file = ROOT.TFile(args.referenceFile, "READ")
+    if args.histo:
+        histo1 = input_file.Get(args.histo)
+        histo2 = ref_file.Get(args.histo)
+        match = compare_histos(histo1, histo2, args.SL, args.test)
+    else:
+        match = compare_files(input_file, ref_file, args.SL, args.test)
+    sys.exit(0 if match else 1)
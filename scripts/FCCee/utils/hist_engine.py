@@ -0,0 +1,519 @@
+"""
+Fill the validation histograms of the FCCee detectors from a declarative spec,
+one YAML file per detector, instead of a hand written event loop.
+
+The spec maps each directory of the output file to a list of histograms:
+
+    DriftChamber:
+      - name: h_DriftChamber_hits
+        title: "Number of hits;Hits;Counts / 5 hits"
+        bins: [40, 0, 200]
+        collection: DCHCollection
+        reduction: count
+
+Each histogram is filled with a quantity computed from a collection:
+    collection: name of the collection in the events tree
+    expression: member of the collection, e.g. "energy" or "position.x", or a
+                function of a vector member: theta, phi, r (transverse) or
+                mag, e.g. "theta(momentum)". Members of related objects are
+                reached through the relation, e.g. "particle.PDG"
+    select:     keep only the elements for which expression is one of values,
+                e.g. {expression: particle.PDG, values: [22, -22]}
+    reduction:  hit (default, one entry per element), count (number of
+                elements per event), sum (sum per event) or first (first
+                element of each event)
+    weight:     optional quantity (same keys) with one value per event used as
+                the weight of the entry of the event
+    relations:  optional mapping from relation names to the collections they
+                point to (MCParticles by default)
+
+By default the columns are read in bulk with uproot, in chunks, and the
+histograms are filled with whole arrays at once. The number of elements of a
+collection (count without expression or select) is taken from the entry
+offsets of the baskets, without decoding the elements.
+
+The rdataframe backend fills the histograms in a multithreaded RDataFrame
+event loop instead. It supports the hit, count and sum reductions of members
+of a collection and the vector functions, without select, relations or
+weights.
+
+ROOT is only imported by the functions that make histograms, so that the
+reading of the columns can be used and tested without it.
+"""
+
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import awkward as ak
+import numpy as np
+import uproot
+import yaml
+
+# resource_usage is shared with the other validation scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import resource_usage  # noqa: E402
+
+# Default amount of data read at once
+STEP_SIZE = "100 MB"
+
+# Number of events of the blocks filled separately and then added
+BLOCK_ENTRIES = 10000
+
+VECTOR_FUNCTIONS = {
+    "theta": lambda x, y, z: np.arctan2(np.hypot(x, y), z),
+    "phi": lambda x, y, z: np.arctan2(y, x),
+    "r": lambda x, y, z: np.hypot(x, y),
+    "mag": lambda x, y, z: np.sqrt(x**2 + y**2 + z**2),
+}
+
+REDUCTIONS = ["hit", "count", "sum", "first"]
+
+# C++ versions of the vector functions, for the RDataFrame backend
+VECTOR_FUNCTIONS_CPP = {
+    "theta": "ROOT::VecOps::atan2(ROOT::VecOps::sqrt({x} * {x} + {y} * {y}), {z})",
+    "phi": "ROOT::VecOps::atan2({y}, {x})",
+    "r": "ROOT::VecOps::sqrt({x} * {x} + {y} * {y})",
+    "mag": "ROOT::VecOps::sqrt({x} * {x} + {y} * {y} + {z} * {z})",
+}
+
+BACKENDS = ["uproot", "rdataframe"]
+
+
+def load_spec(spec_file):
+    """
+    Read a histogram spec and check it, returns a dictionary of directory to
+    list of histograms
+    """
+    with open(spec_file) as f:
+        spec = yaml.load(f, Loader=yaml.FullLoader)
+    for directory, hists in spec.items():
+        for hist in hists:
+            for key in ["name", "title", "bins", "collection"]:
+                if key not in hist:
+                    raise ValueError(f"Histogram in {directory} without {key}: {hist}")
+            if len(hist["bins"]) != 3:
+                raise ValueError(f"bins of {hist['name']} must be [nbins, low, high]")
+            for quantity in [hist, hist.get("weight")]:
+                if quantity is not None and quantity.get("reduction", "hit") not in REDUCTIONS:
+                    raise ValueError(f"Unknown reduction {quantity['reduction']} in {hist['name']}, possible reductions are {REDUCTIONS}")
+            if "weight" in hist:
+                # Weights are given per event
+                if "hit" in [hist.get("reduction", "hit"), hist["weight"].get("reduction", "hit")]:
+                    raise ValueError(f"Histograms with weights, like {hist['name']}, need per-event reductions")
+    return spec
+
+
+class Columns:
+    """
+    Resolve the members of the collections of the spec to branches of the
+    events tree
+    """
+
+    def __init__(self, tree):
+        # Branches are found by the last part of their path, e.g.
+        # DCHCollection/DCHCollection.eDep -> DCHCollection.eDep
+        self.tree = tree
+        self.branches = {key.split("/")[-1]: key for key in tree.keys(recursive=True)}
+
+    def branch(self, name):
+        if name not in self.branches:
+            raise KeyError(f"No branch {name} in the events tree")
+        return self.branches[name]
+
+    def any_member(self, collection):
+        """
+        A branch of the collection with one entry per element, used to
+        count the elements
+        """
+        prefix = f"{collection}."
+        for name, branch in self.branches.items():
+            if name.startswith(prefix) and len(name) > len(prefix):
+                return branch
+        raise KeyError(f"No members of {collection} in the events tree")
+
+    def size_branch(self, collection):
+        """
+        The member of the collection with the fewest bytes among those stored
+        as plain numbers, whose baskets give the number of elements per
+        event from their entry offsets
+        """
+        prefix = f"{collection}."
+        candidates = []
+        for name, key in self.branches.items():
+            if name.startswith(prefix) and len(name) > len(prefix):
+                branch = self.tree[key]
+                interpretation = branch.interpretation
+                if isinstance(interpretation, uproot.AsJagged) and isinstance(interpretation.content, uproot.AsDtype):
+                    candidates.append((branch.compressed_bytes, key))
+        if not candidates:
+            raise KeyError(f"No members of {collection} stored as numbers in the events tree")
+        return min(candidates)[1]
+
+    def member(self, quantity, path):
+        """
+        Branches needed for a member and a function that computes it from a
+        chunk of data
+        """
+        collection = quantity["collection"]
+        if f"{collection}.{path}" in self.branches:
+            branch = self.branch(f"{collection}.{path}")
+            return [branch], lambda chunk: chunk[branch]
+        # Member of a related object: index of the related object in its
+        # collection, -1 when there is none
+        relation, _, rest = path.partition(".")
+        target = quantity.get("relations", {}).get(relation, "MCParticles")
+        index = self.branch(f"_{collection}_{relation}.index")
+        target_branch = self.branch(f"{target}.{rest}")
+
+        def get(chunk):
+            idx = chunk[index]
+            # Elements without a related object get None, so that the
+            # result stays aligned with the other members of the collection
+            return chunk[target_branch][ak.mask(idx, idx >= 0)]
+
+        return [index, target_branch], get
+
+    def expression(self, quantity, expression):
+        if expression.endswith(")") and "(" in expression:
+            function, argument = expression[:-1].split("(", 1)
+            if function not in VECTOR_FUNCTIONS:
+                raise ValueError(f"Unknown function {function}, possible functions are {list(VECTOR_FUNCTIONS)}")
+            components = [self.member(quantity, f"{argument}.{c}") for c in "xyz"]
+            branches = [b for branches, _ in components for b in branches]
+            return branches, lambda chunk: VECTOR_FUNCTIONS[function](*[get(chunk) for _, get in components])
+        return self.member(quantity, expression)
+
+    def quantity(self, quantity):
+        """
+        Branches needed for a quantity of the spec and a function computing
+        it from a chunk of data: a flat array for the hit reduction or one
+        value per event otherwise (None for events without elements with the
+        first reduction)
+        """
+        if "expression" in quantity:
+            branches, values = self.expression(quantity, quantity["expression"])
+        else:
+            branch = self.any_member(quantity["collection"])
+            branches, values = [branch], lambda chunk: chunk[branch]
+        if "select" in quantity:
+            select_branches, selected = self.expression(quantity, quantity["select"]["expression"])
+            branches = branches + select_branches
+            allowed = quantity["select"]["values"]
+
+            def get_values(chunk, values=values):
+                keep = selected(chunk)
+                mask = keep == allowed[0]
+                for value in allowed[1:]:
+                    mask = mask | (keep == value)
+                return values(chunk)[ak.fill_none(mask, False)]
+        else:
+            get_values = values
+
+        # Missing values (elements without a related object) are skipped
+        reduction = quantity.get("reduction", "hit")
+        if reduction == "hit":
+            return branches, lambda chunk: ak.to_numpy(ak.drop_none(ak.flatten(get_values(chunk))))
+        if reduction == "count":
+            return branches, lambda chunk: ak.to_numpy(ak.count(get_values(chunk), axis=1))
+        if reduction == "sum":
+            # Summed in double, like the rdataframe backend
+            return branches, lambda chunk: ak.to_numpy(ak.sum(ak.values_astype(get_values(chunk), np.float64), axis=1))
+        return branches, lambda chunk: ak.firsts(get_values(chunk))
+
+
+def branch_sizes(branch, entry_start=0, entry_stop=None):
+    """
+    Number of elements per event of a jagged branch between entry_start and
+    entry_stop, computed from the byte offsets of the entries in its baskets
+    without interpreting the data
+    """
+    if entry_stop is None:
+        entry_stop = branch.num_entries
+    interpretation = branch.interpretation
+    if not (isinstance(interpretation, uproot.AsJagged) and isinstance(interpretation.content, uproot.AsDtype)):
+        raise ValueError(f"{branch.name} is not a jagged branch of numbers, its sizes can't be read from the byte offsets")
+    itemsize = interpretation.content.from_dtype.itemsize
+    sizes = np.zeros(entry_stop - entry_start, dtype=np.int64)
+    for i in range(branch.num_baskets):
+        start, stop = branch.entry_offsets[i], branch.entry_offsets[i + 1]
+        if stop <= entry_start or start >= entry_stop:
+            continue
+        basket = branch.basket(i)
+        if basket.byte_offsets is not None:
+            basket_sizes = (np.diff(basket.byte_offsets) - interpretation.header_bytes) // itemsize
+        elif basket.counts is not None:
+            # Baskets stored without entry offsets, the sizes are in the
+            # count branch
+            basket_sizes = basket.counts
+        else:
+            raise ValueError(f"Basket {i} of {branch.name} has neither entry offsets nor a count branch")
+        low, high = max(start, entry_start), min(stop, entry_stop)
+        sizes[low - entry_start:high - entry_start] = basket_sizes[low - start:high - start]
+    return sizes
+
+
+def multiplicities(tree, collections, entry_start=0, entry_stop=None):
+    """
+    Number of elements per event of each collection, as a dictionary of
+    collection to NumPy array, read from the entry offsets of one member of
+    each collection. The hits themselves are never decoded
+    """
+    columns = Columns(tree)
+    return {collection: branch_sizes(tree[columns.size_branch(collection)], entry_start, entry_stop)
+            for collection in collections}
+
+
+def is_multiplicity(quantity):
+    """
+    True if a quantity is the plain number of elements of a collection
+    """
+    return quantity.get("reduction", "hit") == "count" and "expression" not in quantity and "select" not in quantity
+
+
+def make_hist(hist):
+    import ROOT
+
+    nbins, low, high = hist["bins"]
+    return ROOT.TH1F(hist["name"], hist["title"], int(nbins), float(low), float(high))
+
+
+def make_hists(spec):
+    """
+    Empty histograms for all the spec, as a dictionary of directory to list
+    of histograms
+    """
+    import ROOT
+
+    hists = {}
+    for directory, hist_specs in spec.items():
+        hists[directory] = []
+        for hist_spec in hist_specs:
+            h = make_hist(hist_spec)
+            # Keep the histograms in memory, not in the current ROOT directory
+            h.SetDirectory(ROOT.nullptr)
+            hists[directory].append(h)
+    return hists
+
+
+def fill(h, values, weights=None):
+    """
+    Fill a histogram with arrays of values and optional weights at once
+    """
+    import ROOT
+
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    if not len(values):
+        return
+    if weights is None:
+        h.FillN(len(values), values, ROOT.nullptr)
+    else:
+        h.FillN(len(values), values, np.ascontiguousarray(weights, dtype=np.float64))
+
+
+def fill_blocks(spec, input_file, blocks, step_size=STEP_SIZE):
+    """
+    Fill the histograms of the spec for each block of entries, given as
+    (entry_start, entry_stop), from the events tree of an EDM4hep file.
+    Returns a list with the histograms of each block
+    """
+    tree = uproot.open(input_file)["events"]
+    columns = Columns(tree)
+    fillers = []
+    counted = []
+    branches = set()
+    for directory, hist_specs in spec.items():
+        for i, hist_spec in enumerate(hist_specs):
+            if is_multiplicity(hist_spec) and "weight" not in hist_spec:
+                counted.append((directory, i, hist_spec["collection"]))
+                continue
+            value_branches, values = columns.quantity(hist_spec)
+            weights = None
+            if "weight" in hist_spec:
+                weight_branches, weights = columns.quantity(hist_spec["weight"])
+                value_branches = value_branches + weight_branches
+            branches.update(value_branches)
+            fillers.append((directory, i, hist_spec.get("reduction", "hit") == "first", values, weights))
+
+    results = []
+    for entry_start, entry_stop in blocks:
+        hists = make_hists(spec)
+        results.append(hists)
+
+        # Histograms of the number of elements per event only need the sizes
+        # of the collections
+        if counted:
+            sizes = multiplicities(tree, {collection for _, _, collection in counted}, entry_start, entry_stop)
+            for directory, i, collection in counted:
+                fill(hists[directory][i], sizes[collection])
+        if not branches:
+            continue
+
+        # All the other histograms are filled from the same chunks, each
+        # column is read only once
+        for chunk in tree.iterate(sorted(branches), entry_start=entry_start, entry_stop=entry_stop,
+                                  step_size=step_size, library="ak"):
+            for directory, i, first, values, weights in fillers:
+                v = values(chunk)
+                w = None if weights is None else weights(chunk)
+                if first:
+                    # Events without elements have no entry
+                    present = ~ak.is_none(v)
+                    v = ak.to_numpy(v[present])
+                    if w is not None:
+                        w = ak.to_numpy(ak.fill_none(w, 0))[ak.to_numpy(present)]
+                elif w is not None:
+                    w = ak.to_numpy(ak.fill_none(w, 0))
+                fill(hists[directory][i], v, w)
+    return results
+
+
+def fill_histograms(spec, input_file, step_size=STEP_SIZE, jobs=1):
+    """
+    Fill all the histograms of the spec from the events tree of an EDM4hep
+    file. Returns the histograms (a dictionary of directory to list of
+    histograms) and the number of events
+
+    The events are split in blocks of BLOCK_ENTRIES entries, each one filled
+    into its own histograms, which are then added in order, like hadd would.
+    With jobs > 1 the blocks are shared between jobs processes. Since the
+    blocks and the order of the additions do not depend on jobs, the results
+    are the same for any number of jobs
+    """
+    n_events = uproot.open(input_file)["events"].num_entries
+    blocks = [(start, min(start + BLOCK_ENTRIES, n_events)) for start in range(0, n_events, BLOCK_ENTRIES)]
+    jobs = max(1, min(jobs, len(blocks)))
+    if jobs == 1:
+        partials = fill_blocks(spec, input_file, blocks, step_size)
+    else:
+        # Contiguous ranges of blocks for each process
+        shards = [[blocks[i] for i in shard] for shard in np.array_split(np.arange(len(blocks)), jobs)]
+        with Pool(jobs) as pool:
+            results = pool.starmap(fill_blocks, [(spec, input_file, shard, step_size) for shard in shards])
+        partials = [hists for result in results for hists in result]
+
+    hists = make_hists(spec)
+    for partial in partials:
+        for directory, h_list in hists.items():
+            for h, h_partial in zip(h_list, partial[directory]):
+                h.Add(h_partial)
+    return hists, n_events
+
+
+def rdf_quantity(df, columns, hist):
+    """
+    Define the quantity of a histogram of the spec on an RDataFrame, returns
+    the new node and the column to histogram: a vector with one entry per
+    element for the hit reduction or a number per event otherwise
+    """
+    for key in ["select", "relations", "weight"]:
+        if key in hist:
+            raise ValueError(f"{hist['name']} uses {key}, which the rdataframe backend does not support")
+    reduction = hist.get("reduction", "hit")
+    if reduction == "first":
+        raise ValueError(f"{hist['name']} uses the first reduction, which the rdataframe backend does not support")
+
+    collection = hist["collection"]
+    expression = hist.get("expression")
+    if expression is None:
+        members = sorted(c for c in columns if c.startswith(f"{collection}."))
+        if not members:
+            raise KeyError(f"No members of {collection} in the events tree")
+        column = members[0]
+    elif expression.endswith(")") and "(" in expression:
+        function, argument = expression[:-1].split("(", 1)
+        if function not in VECTOR_FUNCTIONS_CPP:
+            raise ValueError(f"Unknown function {function}, possible functions are {list(VECTOR_FUNCTIONS_CPP)}")
+        column = f"{hist['name']}_{function}"
+        components = {c: f"{collection}.{argument}.{c}" for c in "xyz"}
+        df = df.Define(column, VECTOR_FUNCTIONS_CPP[function].format(**components))
+    else:
+        column = f"{collection}.{expression}"
+        if column not in columns:
+            raise KeyError(f"No branch {column} in the events tree")
+
+    if reduction == "hit":
+        return df, column
+    value = f"{hist['name']}_{reduction}"
+    if reduction == "count":
+        return df.Define(value, f"static_cast<int>({column}.size())"), value
+    # Summed in double (also for float members), like the uproot backend
+    return df.Define(value, f"ROOT::VecOps::Sum({column}, 0.)"), value
+
+
+def fill_histograms_rdf(spec, input_file, threads=0):
+    """
+    Fill all the histograms of the spec with RDataFrame, with threads
+    threads (0 uses all the cores and 1 disables multithreading). All the
+    histograms are booked lazily and filled in a single event loop. Returns
+    the same as fill_histograms
+    """
+    import ROOT
+
+    if threads != 1 and not ROOT.IsImplicitMTEnabled():
+        ROOT.EnableImplicitMT(threads)
+    df = ROOT.RDataFrame("events", input_file)
+    columns = set(str(c) for c in df.GetColumnNames())
+    booked = {}
+    for directory, hist_specs in spec.items():
+        booked[directory] = []
+        for hist_spec in hist_specs:
+            node, column = rdf_quantity(df, columns, hist_spec)
+            nbins, low, high = hist_spec["bins"]
+            model = ROOT.RDF.TH1DModel(hist_spec["name"], hist_spec["title"], int(nbins), float(low), float(high))
+            booked[directory].append((hist_spec, node.Histo1D(model, column)))
+    n_events = df.Count()
+
+    # The event loop runs when the first result is accessed. The results are
+    # copied to TH1Fs, like the ones of the uproot backend
+    hists = {}
+    for directory, results in booked.items():
+        hists[directory] = []
+        for hist_spec, result in results:
+            h = make_hist(hist_spec)
+            h.SetDirectory(ROOT.nullptr)
+            h.Add(result.GetPtr())
+            hists[directory].append(h)
+    return hists, n_events.GetValue()
+
+
+def make_hists_file(spec, input_file, output_file, norm=False, mode="RECREATE", step_size=STEP_SIZE,
+                    backend="uproot", threads=0, jobs=1, metadata=None, task=None):
+    """
+    Fill the histograms of the spec and write them to output_file, one
+    directory per subsystem. With norm the histograms are normalized by the
+    number of events, once they are complete. The backend is one of BACKENDS,
+    threads is only used by the rdataframe one. With jobs (number of
+    processes) other than 1 the uproot one is used. With metadata, the
+    resources used are recorded for task in that metadata.yaml
+    """
+    import ROOT
+
+    start = time.monotonic()
+    if backend == "rdataframe" and jobs != 1:
+        # RDataFrame runs in a single process, the events are shared between
+        # processes with the uproot backend
+        print(f"INFO: Filling the histograms in {jobs} processes with the uproot backend")
+        backend = "uproot"
+    if backend == "rdataframe":
+        hists, n_events = fill_histograms_rdf(spec, input_file, threads)
+    elif backend == "uproot":
+        hists, n_events = fill_histograms(spec, input_file, step_size, jobs)
+    else:
+        raise ValueError(f"Unknown backend {backend}, possible backends are {BACKENDS}")
+
+    if norm and n_events:
+        for h_list in hists.values():
+            for h in h_list:
+                h.Scale(1.0 / n_events)
+
+    outputFile = ROOT.TFile(output_file, mode)
+    for directory, h_list in hists.items():
+        outputFile.mkdir(directory, "", True).cd()
+        for h in h_list:
+            h.Write()
+    outputFile.Close()
+
+    if metadata is not None:
+        resource_usage.record(metadata, task, resource_usage.own_usage(start, [input_file]))
@@ -0,0 +1,58 @@
+# Measure how long it takes to start the validation scripts, i.e. to import
+# them in a fresh python interpreter, to keep heavy imports (ROOT,
+# matplotlib, uproot) out of the startup of the modules that don't need them
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules imported by plot_runner or by other scripts
+default_modules = ['plot_runner',
+                   'make_distribution_plots',
+                   'make_distribution_hists',
+                   'make_jet_plots',
+                   'expression_utils',
+                   'matplotlib_utils',
+                   ]
+
+
+def time_import(module, repeat):
+    """
+    Time the import of a module in a new interpreter, minus the time it takes
+    to start an interpreter that imports nothing
+    """
+    times = []
+    for statement in ['pass', f'import {module}']:
+        elapsed = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', statement], check=True,
+                           cwd=os.path.dirname(os.path.abspath(__file__)))
+            elapsed.append(time.perf_counter() - start)
+        times.append(statistics.median(elapsed))
+    return times[1] - times[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the import time of the validation scripts')
+    parser.add_argument('modules', nargs='*', default=default_modules, help='Modules to import')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='Number of times each import is repeated, the median is reported')
+    parser.add_argument('--max-seconds', type=float, default=None, help='Fail if any import takes longer than this')
+    args = parser.parse_args()
+
+    failed = []
+    for module in args.modules:
+        elapsed = time_import(module, args.repeat)
+        print(f'{module:30} {elapsed:.3f} s')
+        if args.max_seconds is not None and elapsed > args.max_seconds:
+            failed.append(module)
+    if failed:
+        print(f'Import of {", ".join(failed)} took longer than {args.max_seconds} s')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
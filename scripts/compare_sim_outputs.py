@@ -3,8 +3,10 @@ from datetime import datetime
 from podio.root_io import Reader
 import numpy as np
 import os
+import re
 from tqdm import tqdm
 import sys
+import yaml
 
 # Dictionary defining which members to compare for each collection type
 members_dict = {
@@ -59,6 +61,7 @@ def parse_args():
     parser.add_argument("--output-file", default=None, help="Output file")
 
     parser.add_argument("-m", "--modified-output", action="store_true", help="Use modified output (default: False)")
+    parser.add_argument("--manifest", default=None, help="Manifest written by output_editor.py --campaign, the differences found are checked against the ones expected for the new file")
 
     verbosity_group = parser.add_mutually_exclusive_group()
     verbosity_group.add_argument("-b", "--brief", action="store_const", dest="verbosity", const="brief", help="Brief output")
@@ -184,11 +187,16 @@ def process_event(frame_new, frame_reference, members_dict, frame_it, err_dict,
     reference_collections = frame_reference.getAvailableCollections()
     new_collections = frame_new.getAvailableCollections()
     args = parse_args()
-    modified_colls = []
+    modified_colls = {}
     if args.modified_output:
         # If modified output is used, find which collections have been modified
-        modified_colls = [c[:-9] for c in new_collections if c.endswith("_modified")]
-        new_collections = [c for c in new_collections if not c.endswith("_modified")]
+        # They are named <collection>_modified or <collection>_modified_<name>
+        # when they come from a campaign
+        for c in new_collections:
+            match = re.fullmatch(r"(.+)_modified(_\w+)?", c)
+            if match:
+                modified_colls[match.group(1)] = c
+        new_collections = [c for c in new_collections if c not in modified_colls.values()]
     # Check for missing collections
     if len(reference_collections) != len(new_collections):
         missing_in_new = set(reference_collections) - set(new_collections)
@@ -211,7 +219,7 @@ def process_event(frame_new, frame_reference, members_dict, frame_it, err_dict,
         hit_counter[frame_it][collection] = 0
         err_dict[f"Frame[{frame_it}]"][f"Collection: {collection}"] = {"Errors": [], 'members': {}, 'relations': {}}
         comparison_dict[f"Frame[{frame_it}]"][f"Collection: {collection}"] = {}
-        new_collection = collection + "_modified" if collection in modified_colls else collection
+        new_collection = modified_colls.get(collection, collection)
         hits_new = frame_new.get(new_collection)
         hits_reference = frame_reference.get(collection)
         # Check for different number of hits
@@ -392,6 +400,37 @@ def has_errors(err_dict):
                         return True
     return False
 
+def check_manifest(err_dict, manifest_file, new_file):
+    """
+    Check the bad hits found against the changes listed in a campaign manifest
+    for the new file. Returns the list of mismatches.
+    """
+    with open(manifest_file, "r") as f:
+        manifest = yaml.load(f, Loader=yaml.FullLoader)
+    outputs = [o for o in manifest["outputs"] if os.path.basename(o["output-file"]) == os.path.basename(new_file)]
+    if not outputs:
+        return [f"{os.path.basename(new_file)} not found in manifest {manifest_file}"]
+    output = outputs[0]
+
+    # Changes that leave the value as it was can not be detected
+    expected = {(c["frame"], output["collection"], output["member"], c["hit"]) for c in output["changes"] if c["old"] != c["new"]}
+    found = set()
+    for frame, frame_errors in err_dict.items():
+        frame_it = int(frame[len("Frame["):-1])
+        for collection_key, collection_errors in frame_errors.items():
+            if collection_key == "Errors":
+                continue
+            for member, member_info in collection_errors.get("members", {}).items():
+                for hit_it in member_info["bad_hits"]:
+                    found.add((frame_it, collection_key[len("Collection: "):], member, hit_it))
+
+    mismatches = []
+    for frame_it, collection, member, hit_it in sorted(expected - found):
+        mismatches.append(f"Expected difference not found: Frame[{frame_it}] {collection}[{hit_it}] {member}")
+    for frame_it, collection, member, hit_it in sorted(found - expected):
+        mismatches.append(f"Unexpected difference: Frame[{frame_it}] {collection}[{hit_it}] {member}")
+    return mismatches
+
 def main():
     """
     Main function: parses arguments, loads files, compares events, and writes summary.
@@ -425,6 +464,16 @@ def main():
         f.write(summarize_offsets(comparison_dict, err_dict, verbosity, hit_counter, args))
     print(f"Summary written to {summary_filename}")
 
+    if args.manifest is not None:
+        mismatches = check_manifest(err_dict, args.manifest, args.new_file)
+        for mismatch in mismatches:
+            print(mismatch)
+        if mismatches:
+            print('ManifestMismatch')
+            sys.exit(3)
+        print('ManifestMatch')
+        return
+
     # Exit with error code if any errors are present in err_dict
     if has_errors(err_dict):
         print('ComparisonError')
@@ -0,0 +1,200 @@
+"""
+Safe expressions for the 'function' field of the distribution configuration.
+
+Expressions are written as python lambdas, e.g. 'lambda x, y: np.sqrt(x**2 + y**2)',
+but they are never evaluated with eval: they are parsed into a restricted
+grammar (numbers, the lambda arguments, + - * / **, unary minus and a set of
+mathematical functions) and then either compiled to C++ to be used in an
+RDataFrame Define or turned into a function operating on numpy arrays.
+"""
+import ast
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+
+# Functions allowed in expressions, with the names they can be called with
+# (optionally prefixed by np. or numpy.) and their C++ and numpy equivalents
+FUNCTIONS = {
+    'sqrt': ('sqrt', np.sqrt),
+    'abs': ('abs', np.abs),
+    'exp': ('exp', np.exp),
+    'log': ('log', np.log),
+    'log10': ('log10', np.log10),
+    'sin': ('sin', np.sin),
+    'cos': ('cos', np.cos),
+    'tan': ('tan', np.tan),
+    'arcsin': ('asin', np.arcsin),
+    'arccos': ('acos', np.arccos),
+    'arctan': ('atan', np.arctan),
+    'arctan2': ('atan2', np.arctan2),
+    'sinh': ('sinh', np.sinh),
+    'cosh': ('cosh', np.cosh),
+    'tanh': ('tanh', np.tanh),
+    'hypot': ('hypot', np.hypot),
+    'floor': ('floor', np.floor),
+    'ceil': ('ceil', np.ceil),
+}
+FUNCTIONS['asin'] = FUNCTIONS['arcsin']
+FUNCTIONS['acos'] = FUNCTIONS['arccos']
+FUNCTIONS['atan'] = FUNCTIONS['arctan']
+FUNCTIONS['atan2'] = FUNCTIONS['arctan2']
+
+OPERATORS = {
+    ast.Add: ('+', np.add),
+    ast.Sub: ('-', np.subtract),
+    ast.Mult: ('*', np.multiply),
+    ast.Div: ('/', np.true_divide),
+    ast.Pow: ('**', np.power),
+}
+
+# Functions used in the generated C++ code live in this namespace, where both
+# the overloads for scalars (std) and for RVecs (ROOT::VecOps) are visible
+CPP_PRELUDE = '''
+#include <cmath>
+#include "ROOT/RVec.hxx"
+namespace DistributionExpr {
+using namespace ROOT::VecOps;
+using std::pow;
+%s
+}
+''' % '\n'.join(sorted({f'using std::{cpp};' for cpp, _ in FUNCTIONS.values()}))
+
+_declared = {}
+
+
+class ExpressionError(ValueError):
+    """
+    Raised when an expression is not valid or uses something not allowed
+    """
+
+
+class Expression:
+    """
+    A parsed expression. The arguments of the lambda are matched by position
+    with the columns given in 'var'.
+    """
+    def __init__(self, text):
+        self.text = text
+        try:
+            tree = ast.parse(text.strip(), mode='eval').body
+        except SyntaxError as exc:
+            raise ExpressionError(f'Invalid expression "{text}": {exc}')
+        if not isinstance(tree, ast.Lambda):
+            raise ExpressionError(f'Expression "{text}" has to be a lambda, e.g. "lambda x: x**2"')
+        args = tree.args
+        if args.vararg or args.kwarg or args.kwonlyargs or args.defaults or args.posonlyargs:
+            raise ExpressionError(f'Only plain positional arguments are allowed in "{text}"')
+        self.args = [arg.arg for arg in args.args]
+        self.body = tree.body
+        # Validate the whole expression now, so that errors show up before
+        # anything is read
+        self._cpp = self._to_cpp(self.body)
+        self._numpy = self._to_numpy(self.body)
+
+    def _function(self, node):
+        func = node.func
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id in ('np', 'numpy'):
+            name = func.attr
+        elif isinstance(func, ast.Name):
+            name = func.id
+        else:
+            raise ExpressionError(f'Call not allowed in "{self.text}"')
+        if name not in FUNCTIONS:
+            raise ExpressionError(f'Function "{name}" not allowed in "{self.text}", the allowed functions are {sorted(FUNCTIONS)}')
+        if node.keywords:
+            raise ExpressionError(f'Keyword arguments are not allowed in "{self.text}"')
+        return FUNCTIONS[name]
+
+    def _to_cpp(self, node):
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return repr(node.value)
+        if isinstance(node, ast.Name):
+            if node.id not in self.args:
+                raise ExpressionError(f'Unknown variable "{node.id}" in "{self.text}"')
+            return node.id
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            op = '-' if isinstance(node.op, ast.USub) else '+'
+            return f'({op}{self._to_cpp(node.operand)})'
+        if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            left, right = self._to_cpp(node.left), self._to_cpp(node.right)
+            if isinstance(node.op, ast.Pow):
+                return f'pow({left}, {right})'
+            if isinstance(node.op, ast.Div):
+                # True division, as in python, also for integer columns
+                return f'(1.0 * {left} / {right})'
+            return f'({left} {OPERATORS[type(node.op)][0]} {right})'
+        if isinstance(node, ast.Call):
+            cpp, _ = self._function(node)
+            return f'{cpp}({", ".join(self._to_cpp(arg) for arg in node.args)})'
+        raise ExpressionError(f'"{ast.unparse(node)}" is not allowed in "{self.text}"')
+
+    def _to_numpy(self, node):
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            value = node.value
+            return lambda env: value
+        if isinstance(node, ast.Name):
+            name = node.id
+            return lambda env: env[name]
+        if isinstance(node, ast.UnaryOp):
+            operand = self._to_numpy(node.operand)
+            if isinstance(node.op, ast.USub):
+                return lambda env: np.negative(operand(env))
+            return operand
+        if isinstance(node, ast.BinOp):
+            left, right = self._to_numpy(node.left), self._to_numpy(node.right)
+            op = OPERATORS[type(node.op)][1]
+            return lambda env: op(left(env), right(env))
+        if isinstance(node, ast.Call):
+            _, func = self._function(node)
+            args = [self._to_numpy(arg) for arg in node.args]
+            return lambda env: func(*[arg(env) for arg in args])
+        raise ExpressionError(f'"{ast.unparse(node)}" is not allowed in "{self.text}"')
+
+    def __call__(self, *arrays):
+        """
+        Evaluate the expression on numpy arrays
+        """
+        if len(arrays) != len(self.args):
+            raise ExpressionError(f'Expression "{self.text}" takes {len(self.args)} arguments but {len(arrays)} columns were given')
+        return self._numpy(dict(zip(self.args, arrays)))
+
+    def declare_cpp(self, types):
+        """
+        Declare a C++ function computing the expression for arguments of the
+        given types and return its name, or None if it does not compile.
+        Functions are declared only once per expression and types.
+        """
+        import ROOT
+
+        if len(types) != len(self.args):
+            raise ExpressionError(f'Expression "{self.text}" takes {len(self.args)} arguments but {len(types)} columns were given')
+        key = (self.text, tuple(types))
+        if key in _declared:
+            return _declared[key]
+        if not _declared:
+            ROOT.gInterpreter.Declare(CPP_PRELUDE)
+        name = 'expr_' + hashlib.sha1(repr(key).encode()).hexdigest()[:12]
+        args = ', '.join(f'const {typ}& {arg}' for typ, arg in zip(types, self.args))
+        code = f'namespace DistributionExpr {{ auto {name}({args}) {{ return {self._cpp}; }} }}'
+        _declared[key] = f'DistributionExpr::{name}' if ROOT.gInterpreter.Declare(code) else None
+        return _declared[key]
+
+    def define(self, rdf, name, columns):
+        """
+        Define a column with the result of the expression on an RDataFrame,
+        returns the new node or None if the expression can not be compiled
+        for the types of the columns
+        """
+        function = self.declare_cpp([rdf.GetColumnType(col) for col in columns])
+        if function is None:
+            return None
+        return rdf.Define(name, f'{function}({", ".join(columns)})')
+
+
+@lru_cache(maxsize=None)
+def parse_expression(text):
+    """
+    Parse an expression, expressions with the same text are parsed only once
+    """
+    return Expression(text)
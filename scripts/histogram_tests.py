@@ -0,0 +1,153 @@
+"""
+Statistical comparison of current and reference histograms. All the pairs of
+histograms of a run are stacked into 2D arrays (one row per histogram, padded
+with empty bins) and compared at once with
+    chi2: chi2 test for two unweighted histograms
+    ks: Kolmogorov-Smirnov test on the binned cumulative distributions
+    mean, width: shift of the mean and of the standard deviation in units of
+                 their uncertainty in the reference
+The results are a status table, one row per histogram sorted from the worst
+to the best agreement, that is used to flag the plots and shown in the web
+pages.
+"""
+import math
+
+import numpy as np
+import yaml
+
+# Number of sigmas for the mean and width shifts to fail
+threshold = 3
+# p-value below which the chi2 and KS tests fail
+p_value_threshold = 1e-3
+
+_erfc = np.vectorize(math.erfc, otypes=[float])
+
+
+def stack(hists):
+    """
+    Stack the counts of histograms made with make_histogram into a 2D array,
+    padding the shorter ones with empty bins, and their statistics into 1D
+    arrays
+    """
+    nbins = max(len(hist['counts']) for hist in hists)
+    counts = np.zeros((len(hists), nbins))
+    for i, hist in enumerate(hists):
+        counts[i, :len(hist['counts'])] = hist['counts']
+    stats = {k: np.array([hist[k] for hist in hists], dtype=float) for k in ['mean', 'std', 'entries']}
+    return counts, stats
+
+
+def chi2_p_value(chi2, ndf):
+    """
+    Probability of a chi2 at least as large, using the Wilson-Hilferty
+    approximation
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = ((chi2 / ndf)**(1 / 3) - (1 - 2 / (9 * ndf))) / np.sqrt(2 / (9 * ndf))
+    return np.where(ndf > 0, 0.5 * _erfc(np.nan_to_num(z) / np.sqrt(2)), 1.)
+
+
+def ks_p_value(distance, n):
+    """
+    Probability of a KS distance at least as large for an effective number
+    of entries n, from the asymptotic Kolmogorov distribution
+    """
+    x = np.asarray(np.sqrt(n) * distance, dtype=float)
+    k = np.arange(1, 101)[:, None]
+    p = np.ones(x.shape)
+    # The alternating series only converges for large x, small x use
+    # 1 - sqrt(2 pi) / x sum exp(-(2k - 1)^2 pi^2 / (8 x^2)), which is
+    # indistinguishable from 1 below x = 0.2
+    small = (x > 0.2) & (x < 1)
+    large = x >= 1
+    xs = x[small]
+    p[small] = 1 - np.sqrt(2 * np.pi) / xs * np.sum(np.exp(-(2 * k - 1)**2 * np.pi**2 / (8 * xs**2)), axis=0)
+    xl = x[large]
+    p[large] = 2 * np.sum((-1.)**(k - 1) * np.exp(-2 * k**2 * xl**2), axis=0)
+    return np.clip(p, 0, 1)
+
+
+def compare(current, reference):
+    """
+    Run all the tests on lists of current and reference histograms, returns
+    a dictionary of arrays with one entry per pair
+    """
+    n1, stats1 = stack(current)
+    n2, stats2 = stack(reference)
+    nbins = max(n1.shape[1], n2.shape[1])
+    n1 = np.pad(n1, ((0, 0), (0, nbins - n1.shape[1])))
+    n2 = np.pad(n2, ((0, 0), (0, nbins - n2.shape[1])))
+    sum1 = n1.sum(axis=1, keepdims=True)
+    sum2 = n2.sum(axis=1, keepdims=True)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Only bins with entries in any of the histograms count
+        filled = (n1 + n2) > 0
+        terms = (sum2 * n1 - sum1 * n2)**2 / (sum1 * sum2 * (n1 + n2))
+        chi2 = np.where(filled, terms, 0).sum(axis=1)
+        ndf = filled.sum(axis=1) - 1
+
+        cdf1 = np.cumsum(n1, axis=1) / sum1
+        cdf2 = np.cumsum(n2, axis=1) / sum2
+        ks = np.nan_to_num(np.abs(cdf1 - cdf2)).max(axis=1)
+        n_eff = (sum1 * sum2 / (sum1 + sum2))[:, 0]
+
+        sigma = stats2['std']
+        mean_shift = np.abs(stats1['mean'] - stats2['mean']) / (sigma / np.sqrt(stats2['entries']))
+        width_shift = np.abs(stats1['std'] - stats2['std']) / (sigma / np.sqrt(2 * stats2['entries']))
+
+    empty = (sum1[:, 0] == 0) | (sum2[:, 0] == 0)
+    chi2 = np.where(empty, 0, chi2)
+    return {'chi2': chi2,
+            'ndf': np.where(empty, 0, ndf),
+            'chi2_p_value': chi2_p_value(chi2, np.where(empty, 0, ndf)),
+            'ks': ks,
+            'ks_p_value': np.where(empty, 1., ks_p_value(ks, np.nan_to_num(n_eff))),
+            'mean_shift': np.nan_to_num(mean_shift, posinf=np.inf),
+            'width_shift': np.nan_to_num(width_shift, posinf=np.inf),
+            }
+
+
+def status_table(names, current, reference):
+    """
+    Status table with the results of all the tests for each pair of
+    histograms, sorted from the worst to the best agreement
+    """
+    results = compare(current, reference)
+    failed = {'chi2': results['chi2_p_value'] < p_value_threshold,
+              'ks': results['ks_p_value'] < p_value_threshold,
+              'mean': results['mean_shift'] > threshold,
+              'width': results['width_shift'] > threshold,
+              }
+    p_value = np.minimum(results['chi2_p_value'], results['ks_p_value'])
+    table = []
+    for i, name in enumerate(names):
+        row = {'name': name}
+        row.update({k: v[i].item() for k, v in results.items()})
+        row['failed'] = [test for test, f in failed.items() if f[i]]
+        row['status'] = 'fail' if row['failed'] else 'ok'
+        row['p_value'] = p_value[i].item()
+        table.append(row)
+    table.sort(key=lambda row: (row['status'] == 'ok', row['p_value'], -row['mean_shift']))
+    return table
+
+
+def check_plots(plots, filename='status.yaml'):
+    """
+    Run the tests for all the plots that have a current and a reference
+    histogram, mark the ones that fail with 'alert' and write the status
+    table to filename
+    """
+    plots = [plot for plot in plots if plot.get('current') is not None and plot.get('reference') is not None]
+    if not plots:
+        return []
+    table = status_table([plot['filename'] for plot in plots],
+                         [plot['current'] for plot in plots],
+                         [plot['reference'] for plot in plots])
+    status = {row['name']: row['status'] for row in table}
+    for plot in plots:
+        plot['alert'] = status[plot['filename']] == 'fail'
+    if filename is not None:
+        with open(filename, 'w') as f:
+            yaml.dump(table, f, sort_keys=False)
+    return table
@@ -1,8 +1,10 @@
 import argparse
+from collections import OrderedDict
+
 import numpy as np
-import matplotlib.pyplot as plt
 import uproot
-from matplotlib_utils import add_table
+from matplotlib_utils import draw_hist_plots
+from histogram_tests import check_plots
 
 label_map = {'trueP': 'True $p$ [GeV]',
              'truePt': 'True $p_T$ [GeV]',
@@ -19,21 +21,190 @@ label_map = {'trueP': 'True $p$ [GeV]',
              'recoZ0': 'Reconstructed $z_0$ [mm]',
              }
 
-# Number of sigmas away from the mean to make the plot red
-threshold = 3
+# Maximum amount of data read at once, so that memory stays bounded for files
+# of any size
+default_step_size = '100 MB'
+
+# Maximum size of the branches kept in memory to be reused between passes
+default_max_cache_bytes = 1024**3
+
+resolution_tree = 'MyClicEfficiencyCalculator/perfTree;1'
+resolution_pairs = [['trueP', 'recoP'], ['truePt', 'recoPt'], ['trueTheta', 'recoTheta'], ['truePhi', 'recoPhi'], ['trueD0', 'recoD0'], ['trueZ0', 'recoZ0'],]
+
+
+class StreamingHistogram:
+    """
+    Histogram and statistics filled chunk by chunk, the result is the same as
+    make_histogram with all the values at once
+    """
+    def __init__(self, edges):
+        self.edges = edges
+        self.counts = np.zeros(len(edges) - 1, dtype=np.int64)
+        self.entries = 0
+        self.mean = 0.
+        # Sum of squared differences from the mean
+        self.m2 = 0.
+
+    def fill(self, values):
+        if not values.size:
+            return
+        self.counts += np.histogram(values, bins=self.edges)[0]
+        # Merge the mean and variance of the chunk with the accumulated ones
+        n = values.size
+        mean = values.mean()
+        m2 = ((values - mean)**2).sum()
+        total = self.entries + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta**2 * self.entries * n / total
+        self.entries = total
+
+    def result(self):
+        std = np.sqrt(self.m2 / self.entries) if self.entries else 0.
+        return {'counts': self.counts, 'edges': self.edges,
+                'mean': self.mean, 'std': std, 'entries': self.entries}
+
+
+def flatten(array):
+    """
+    Flatten the values of a jagged branch
+    """
+    if array.dtype == object:
+        return np.concatenate(array) if len(array) else np.array([])
+    return array
 
-# x, y, width, height
-table_dimensions_left = [0.5, 0.7, 0.25, 0.2]
-table_dimensions_right = [0.75, 0.7, 0.25, 0.2]
 
+class BranchCache:
+    """
+    Flat arrays of whole branches kept in memory and keyed by (file, tree,
+    branch), so that the branches needed by several passes or plots are read
+    only once. The least recently used branches are evicted when the arrays
+    take more than max_bytes
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.arrays = OrderedDict()
+        self.nbytes = 0
 
-def main(root_file, reference_root_file):
+    @staticmethod
+    def key(tree, branch):
+        return (tree.file.file_path, tree.object_path, branch)
+
+    def size(self, tree, branch):
+        key = self.key(tree, branch)
+        if key in self.arrays:
+            return self.arrays[key].nbytes
+        return tree[branch].uncompressed_bytes
+
+    def fits(self, tree, branches):
+        """
+        Whether all the branches can be in memory at the same time
+        """
+        return sum(self.size(tree, branch) for branch in branches) <= self.max_bytes
+
+    def get(self, tree, branches):
+        """
+        Flat arrays of the branches, reading only the ones that are not in
+        the cache
+        """
+        result = {}
+        missing = []
+        for branch in branches:
+            key = self.key(tree, branch)
+            if key in self.arrays:
+                self.arrays.move_to_end(key)
+                result[branch] = self.arrays[key]
+            else:
+                missing.append(branch)
+        if missing:
+            arrays = tree.arrays(missing, library='np')
+            for branch in missing:
+                result[branch] = flatten(arrays[branch])
+                self.put(self.key(tree, branch), result[branch])
+        return result
+
+    def put(self, key, array):
+        self.arrays[key] = array
+        self.nbytes += array.nbytes
+        while self.nbytes > self.max_bytes and len(self.arrays) > 1:
+            _, evicted = self.arrays.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+
+def iterate_chunks(tree, branches, step_size, cache=None):
+    """
+    Read the branches of a tree in chunks of at most step_size, yielding
+    dictionaries with flat numpy arrays. When the branches fit in the cache
+    they are yielded at once from it
+    """
+    if cache is not None and cache.fits(tree, branches):
+        yield cache.get(tree, branches)
+        return
+    for chunk in tree.iterate(branches, step_size=step_size, library='np'):
+        yield {name: flatten(chunk[name]) for name in branches}
+
+
+def stream_ranges(tree, branches, variables, step_size, ranges=None, cache=None):
+    """
+    Cheap first pass over a tree to find the minimum and maximum of each
+    variable. variables maps names to functions computing the values from a
+    chunk and ranges (updated in place) can already contain ranges from
+    another tree
+    """
+    ranges = {} if ranges is None else ranges
+    for chunk in iterate_chunks(tree, branches, step_size, cache):
+        for name, get in variables.items():
+            values = get(chunk)
+            if not values.size:
+                continue
+            low, high = values.min(), values.max()
+            if name in ranges:
+                low, high = min(low, ranges[name][0]), max(high, ranges[name][1])
+            ranges[name] = (low, high)
+    return ranges
+
+
+def stream_histograms(tree, branches, variables, edges, step_size, cache=None):
+    """
+    Fill the histograms of the variables that have edges, chunk by chunk
+    """
+    hists = {name: StreamingHistogram(edges[name]) for name in variables if name in edges}
+    for chunk in iterate_chunks(tree, branches, step_size, cache):
+        for name, hist in hists.items():
+            hist.fill(variables[name](chunk))
+    return {name: hist.result() for name, hist in hists.items()}
+
+
+def uniform_edges(low, high, bins):
+    """
+    Edges of bins equally spaced between low and high, like np.histogram does
+    """
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    return np.linspace(low, high, bins + 1)
+
+
+def get_edges(current, reference, branches, variables, bins, step_size, edges_from, cache=None):
+    """
+    Edges for each variable, either from the range of both trees
+    (edges_from='range') or only from the reference (edges_from='reference'),
+    which avoids a pass over the current tree
+    """
+    ranges = stream_ranges(reference, branches, variables, step_size, cache=cache)
+    if edges_from == 'range':
+        ranges = stream_ranges(current, branches, variables, step_size, ranges, cache)
+    return {name: uniform_edges(low, high, bins) for name, (low, high) in ranges.items()}
+
+
+def main(root_file, reference_root_file, jobs=None, step_size=default_step_size, edges_from='range',
+         max_cache_bytes=default_max_cache_bytes, render_cache='.render_cache'):
     upr = uproot.open(root_file)
     ref = uproot.open(reference_root_file)
     assert all(k in ref.keys() for k in upr.keys())
+    # Shared by all the passes over the trees
+    cache = BranchCache(max_cache_bytes) if max_cache_bytes else None
 
-    fig, ax = plt.subplots(1, 1, figsize=(3.72, 2.3))
-
+    plots = []
     for k in upr.keys():
         try:
             upr[k].classname
@@ -44,84 +215,68 @@ def main(root_file, reference_root_file):
             print(f'Skipping {k}, not a TTree')
             continue
 
+        branches = list(upr[k].keys())
+        variables = {name: (lambda chunk, name=name: chunk[name]) for name in branches}
         try:
-            arrays_current = upr[k].arrays(library='np')
+            edges = get_edges(upr[k], ref[k], branches, variables, 14, step_size, edges_from, cache)
+            hists_current = stream_histograms(upr[k], branches, variables, edges, step_size, cache)
+            hists_reference = stream_histograms(ref[k], branches, variables, edges, step_size, cache)
         except AttributeError:
-            print(f'Skipping {k}, no arrays found in the current sample')
+            print(f'Skipping {k}, no arrays found')
             continue
-        try:
-            arrays_reference = ref[k].arrays(library='np')
-        except AttributeError:
-            print(f'Skipping {k}, no arrays found in the reference sample')
-            continue
-        for name in arrays_current.keys():
-            print(f'{name}: {arrays_current[name].dtype}')
-
-            dist_current = arrays_current[name]
-            dist_reference = arrays_reference[name]
-            if dist_current.dtype == object:
-                dist_current = np.concatenate(dist_current)
-                dist_reference = np.concatenate(dist_reference)
-            if not dist_current.size:
+        for name in branches:
+            print(f'{name}: {upr[k][name].typename}')
+            if name not in hists_current or not hists_current[name]['entries']:
                 continue
+            current = hists_current[name]
+            reference = hists_reference[name]
+
+            plots.append({'filename': f'hist-{name}.svg',
+                          'current': current,
+                          'reference': reference,
+                          'xlabel': label_map[name] if name in label_map else name,
+                          })
+
+
+    branches = [branch for pair in resolution_pairs for branch in pair]
+    variables = {f'{gen}-{reco}': (lambda chunk, gen=gen, reco=reco: chunk[gen] - chunk[reco])
+                 for gen, reco in resolution_pairs}
+    # The binning follows the current sample unless it is taken from the reference
+    edge_tree = ref[resolution_tree] if edges_from == 'reference' else upr[resolution_tree]
+    ranges = stream_ranges(edge_tree, branches, variables, step_size, cache=cache)
+    edges = {name: uniform_edges(low, high, 20) for name, (low, high) in ranges.items()}
+    hists_current = stream_histograms(upr[resolution_tree], branches, variables, edges, step_size, cache)
+    hists_reference = stream_histograms(ref[resolution_tree], branches, variables, edges, step_size, cache)
+    for gen, reco in resolution_pairs:
+        name = f'{gen}-{reco}'
+        if name not in edges:
+            continue
+        current = hists_current[name]
+        reference = hists_reference[name]
+
+        plots.append({'filename': f'hist-{name}.svg',
+                      'current': current,
+                      'reference': reference,
+                      'xlabel': f'{label_map[gen]} - {label_map[reco]}',
+                      })
 
-            bins = np.linspace(min(dist_current.min(), dist_reference.min()), max(dist_current.max(), dist_reference.max()), 15)
-            _, bins, _ = ax.hist(dist_current, bins=bins, histtype='step', label='Current', density=True)
-            ax.hist(dist_reference, bins=bins, histtype='step', label='Reference', density=True)
-
-            left = ['Mean', 'Std. Dev.', 'Entries']
-            right_current_values = [dist_current.mean(), dist_current.std(), len(dist_current)]
-            right_current_labels = [f'{right_current_values[0]:.2f}', f'{right_current_values[1]:.2f}', f'{right_current_values[2]}']
-            add_table(left, right_current_labels, ax, table_dimensions_left, title='Current')
-            right_reference_values = [dist_reference.mean(), dist_reference.std(), len(dist_reference)]
-            right_reference_labels = [f'{right_reference_values[0]:.2f}', f'{right_reference_values[1]:.2f}', f'{right_reference_values[2]}']
-            add_table(left, right_reference_labels, ax, table_dimensions_right, title='Reference')
-
-            # If the mean is more than threshold sigma away from the reference, make the plot red
-            if abs(right_current_values[0] - right_reference_values[0]) > threshold*(right_reference_values[1] / np.sqrt(len(dist_reference))):
-                fig.patch.set_facecolor('red')
-
-            ax.legend()
-            ax.set_ylabel('Entries [a.u.]')
-            ax.set_xlabel(label_map[name] if name in label_map else name)
-            ax.set_ylim(ax.get_ylim()[0], ax.get_ylim()[1]*1.2)
-            fig.savefig(f'hist-{name}.svg')
-            ax.clear()
-            fig.patch.set_facecolor('white')
-
-
-    k = 'MyClicEfficiencyCalculator/perfTree;1'
-    for gen, reco in [['trueP', 'recoP'], ['truePt', 'recoPt'], ['trueTheta', 'recoTheta'], ['truePhi', 'recoPhi'], ['trueD0', 'recoD0'], ['trueZ0', 'recoZ0'],]:
-        dist_current = upr[k].arrays(library='np')[gen] - upr[k].arrays(library='np')[reco]
-        dist_reference = ref[k].arrays(library='np')[gen] - ref[k].arrays(library='np')[reco]
-        if dist_current.dtype == object:
-            dist_current = np.concatenate(dist_current)
-            dist_reference = np.concatenate(dist_reference)
-        _, bins, _ = ax.hist(dist_current, bins=20, histtype='step', label='Current', density=True)
-        ax.hist(dist_reference, bins=bins, histtype='step', label='Reference', density=True)
-        left = ['Mean', 'Std. Dev.', 'Entries']
-        right_current_values = [dist_current.mean(), dist_current.std(), len(dist_current)]
-        right_current_labels = [f'{right_current_values[0]:.2f}', f'{right_current_values[1]:.2f}', f'{right_current_values[2]}']
-        add_table(left, right_current_labels, ax, table_dimensions_left, title='Current')
-        right_reference_values = [dist_reference.mean(), dist_reference.std(), len(dist_reference)]
-        right_reference_labels = [f'{right_reference_values[0]:.2f}', f'{right_reference_values[1]:.2f}', f'{right_reference_values[2]}']
-        add_table(left, right_reference_labels, ax, table_dimensions_right, title='Reference')
-
-        # If the mean is more than threshold sigma away from the reference, make the plot red
-        if abs(right_current_values[0] - right_reference_values[0]) > threshold*(right_reference_values[1] / np.sqrt(len(dist_reference))):
-            fig.patch.set_facecolor('red')
-
-        ax.legend()
-        ax.set_xlabel(f'{label_map[gen]} - {label_map[reco]}')
-        ax.set_ylabel('Entries [a.u.]')
-        ax.set_ylim(ax.get_ylim()[0], ax.get_ylim()[1]*1.2)
-        fig.savefig(f'hist-{gen}-{reco}.svg')
-        ax.clear()
+    # The plots that fail any of the tests are made red
+    check_plots(plots)
+    draw_hist_plots(plots, jobs, render_cache)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Make plots of jet variables from the jet study root file')
     parser.add_argument('root_file', help='Path to the root file')
     parser.add_argument('reference_root_file', help='Path to the reference root file')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of processes drawing the plots (default: number of cores)')
+    parser.add_argument('--step-size', default=default_step_size, help='Maximum amount of data read at once, e.g. "100 MB"')
+    parser.add_argument('--edges', choices=['range', 'reference'], default='range',
+                        help='Take the binning from the range of both samples or only from the reference, which saves a pass over the current sample')
+    parser.add_argument('--max-cache-size', type=float, default=default_max_cache_bytes / 1024**3,
+                        help='Maximum size in GiB of the branches kept in memory between passes, 0 to disable')
+    parser.add_argument('--render-cache', default='.render_cache', help='Directory with the plots already drawn, reused when their content does not change')
+    parser.add_argument('--no-render-cache', action='store_true', help='Draw all the plots')
     args = parser.parse_args()
-    main(args.root_file, args.reference_root_file)
+    main(args.root_file, args.reference_root_file, args.jobs, args.step_size, args.edges, int(args.max_cache_size * 1024**3),
+         None if args.no_render_cache else args.render_cache)
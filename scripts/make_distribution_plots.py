@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
 
-import ROOT
-
+# ROOT and matplotlib are only imported when they are needed, so that
+# importing this module is cheap and has no side effects
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
 
 import yaml
 from yaml.nodes import ScalarNode
 import os
+import glob
+import hashlib
+import json
+from collections import OrderedDict
 
-from matplotlib_utils import add_table
+from expression_utils import parse_expression
 
 # Load the implementations of the utility functions
 # ROOT.gSystem.Load('libedm4hepRDF.so')
@@ -17,23 +21,111 @@ from matplotlib_utils import add_table
 # compilation
 # ROOT.gInterpreter.LoadFile('edm4hep/utils/dataframe.h')
 
-ROOT.EnableImplicitMT()
+def load_conf(conf_file):
+    """
+    Read the configuration file
+    """
+    with open(conf_file, 'r') as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
 
-with open('conf.yaml', 'r') as f:
-    try:
-        conf = yaml.load(f, Loader=yaml.FullLoader)
-    except yaml.YAMLError as exc:
-        print(exc)
-        exit()
+def do_nothing(x):
+    return x
+
+def to_numpy(ptr):
+    """
+    Convert the result of a Take to a flat numpy array, concatenating the
+    values of all the events when the column is a collection
+    """
+    values = ptr.GetValue()
+    if len(values) and hasattr(values[0], '__len__'):
+        return np.concatenate([np.asarray(x) for x in values])
+    return np.asarray(values)
+
+def get_range(low, high):
+    """
+    Range of the histogram for values between low and high, both included
+    """
+    if low == high:
+        return low - 0.5, high + 0.5
+    return low, np.nextafter(high, np.inf)
+
+def hist_to_numpy(h):
+    """
+    Bin contents and edges of a TH1, without underflow and overflow
+    """
+    n = h.GetNbinsX()
+    counts = np.array([h.GetBinContent(i) for i in range(1, n + 1)])
+    edges = np.array([h.GetBinLowEdge(i) for i in range(1, n + 2)])
+    return counts, edges
 
-def std(dist):
-    return np.std(dist)
+# Increase when the way results are computed changes, to invalidate the
+# persistent cache
+CACHE_VERSION = 2
 
-def mean(dist):
-    return np.mean(dist)
+_identities = {}
 
-def do_nothing(x):
-    return x
+def file_identity(filename, block=1024**2):
+    """
+    Identity of a file for the persistent cache: its size, modification time
+    and a checksum of its first and last blocks
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    if key not in _identities:
+        checksum = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            checksum.update(f.read(block))
+            if stat.st_size > block:
+                f.seek(max(block, stat.st_size - block))
+                checksum.update(f.read(block))
+        _identities[key] = [stat.st_size, stat.st_mtime_ns, checksum.hexdigest()]
+    return _identities[key]
+
+def save_results(cache_dir, key, results):
+    """
+    Save the results of an entry (bin contents, edges and statistics of each
+    sample) to the persistent cache
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    arrays = {}
+    for k, (counts, edges, mean, std, entries) in results.items():
+        arrays[f'{k}_counts'] = counts
+        arrays[f'{k}_edges'] = edges
+        arrays[f'{k}_stats'] = np.array([mean, std, entries], dtype=np.float64)
+    np.savez_compressed(os.path.join(cache_dir, f'{key}.npz'), **arrays)
+
+def load_results(cache_dir, key):
+    """
+    Load the results of an entry from the persistent cache, None if they are
+    not there
+    """
+    path = os.path.join(cache_dir, f'{key}.npz')
+    if not os.path.exists(path):
+        return None
+    results = {}
+    with np.load(path) as f:
+        for k in ['new', 'ref']:
+            if f'{k}_counts' not in f:
+                continue
+            mean, std, entries = f[f'{k}_stats']
+            results[k] = (f[f'{k}_counts'], f[f'{k}_edges'], mean, std, int(entries))
+    return results
+
+
+def get_files(spec):
+    """
+    Return the files of a dataset as a tuple. A dataset can be given as a
+    file, a glob pattern or a list of files and patterns
+    """
+    if not isinstance(spec, list):
+        spec = [spec]
+    files = []
+    for pattern in spec:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            raise FileNotFoundError(f'No files found matching {pattern}')
+        files.extend(matches)
+    return tuple(files)
 
 
 class Reader:
@@ -46,30 +138,132 @@ class Reader:
 
         for key, val in conf.items():
             if 'filename' in val:
-                self.filenames.add(val['filename'])
+                self.filenames.add(get_files(val['filename']))
             if 'reference' in val:
-                self.filenames.add(val['reference'])
+                self.filenames.add(get_files(val['reference']))
         print(f'List of files that will be read {self.filenames}')
 
     def check_filenames(self):
-        for filename in self.filenames:
-            if not os.path.exists(filename):
-                raise FileNotFoundError
+        for filenames in self.filenames:
+            for filename in filenames:
+                if not os.path.exists(filename):
+                    raise FileNotFoundError(filename)
 
     def get_rdfs(self):
+        """
+        Create one RDataFrame per dataset, chaining all its files
+        """
+        import ROOT
+
         ls = {}
-        for filename in self.filenames:
-            ls[filename] = ROOT.RDataFrame('events', filename)
+        for filenames in self.filenames:
+            ls[filenames] = ROOT.RDataFrame('events', list(filenames))
         return ls
 
 
+class DataCache:
+    """
+    Cache between the RDataFrames and the plotting code. Actions booked for
+    the same file, filter and column (or function of columns) are shared by
+    all the entries, so each unique column set is read once per file.
+    Materialized columns are kept in memory and evicted, least recently used
+    first, when their size goes over max_bytes
+    """
+    def __init__(self, rdfs, max_bytes=2 * 1024**3):
+        self.rdfs = rdfs
+        self.max_bytes = max_bytes
+        self.nodes = {}
+        self.defined = {}
+        self.actions = {}
+        self.arrays = OrderedDict()
+        self.nbytes = 0
+
+    def node(self, filenames, filt=None):
+        """
+        Return the key of the node of a dataset with an optional filter
+        """
+        key = (filenames, filt)
+        if key not in self.nodes:
+            rdf = self.rdfs[filenames]
+            self.nodes[key] = rdf if filt is None else rdf.Filter(filt)
+        return key
+
+    def define(self, node, func, columns):
+        """
+        Define a function of columns on a node. Returns the key of the new
+        node and the name of the column, or None if the function can not be
+        compiled for those columns
+        """
+        key = node + (func.text, tuple(columns))
+        if key not in self.nodes:
+            self.defined[key] = f'expr_{len(self.nodes)}'
+            self.nodes[key] = func.define(self.nodes[node], self.defined[key], list(columns))
+        if self.nodes[key] is None:
+            return None
+        return key, self.defined[key]
+
+    def book(self, node, action, var, *args):
+        """
+        Book an action (Min, Max, Histo1D or Take) on a node, unless it has
+        already been booked
+        """
+        key = (node, action, var) + args
+        if key not in self.actions:
+            rdf = self.nodes[node]
+            if action == 'Histo1D':
+                import ROOT
+
+                bins, low, high = args
+                model = ROOT.RDF.TH1DModel(f'h_{len(self.actions)}', '', bins, low, high)
+                self.actions[key] = rdf.Histo1D(model, var)
+            elif action == 'Take':
+                self.actions[key] = rdf.Take[rdf.GetColumnType(var)](var)
+            else:
+                self.actions[key] = getattr(rdf, action)(var)
+        return self.actions[key]
+
+    def pending(self):
+        """
+        Actions booked that have not run yet
+        """
+        return [ptr for ptr in self.actions.values() if not ptr.IsReady()]
+
+    def column(self, node, var):
+        """
+        Return a column as a flat numpy array, reading it again if it has been
+        evicted from the cache
+        """
+        key = (node, var)
+        if key in self.arrays:
+            self.arrays.move_to_end(key)
+            return self.arrays[key]
+        ptr = self.actions.pop((node, 'Take', var), None)
+        if ptr is None:
+            ptr = self.book(node, 'Take', var)
+            del self.actions[(node, 'Take', var)]
+        array = to_numpy(ptr)
+        self.arrays[key] = array
+        self.nbytes += array.nbytes
+        while self.nbytes > self.max_bytes and len(self.arrays) > 1:
+            _, evicted = self.arrays.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return array
+
+
 class Validator:
     """
     Class to run the validation
     """
-    def __init__(self, conf):
+    def __init__(self, conf, max_cache_bytes=2 * 1024**3, cache_dir='.validation_cache', threads=0, jobs=None):
         self.conf = conf
         self.groups = {}
+        # Number of threads for the event loops, 0 uses all the cores and 1
+        # disables multithreading
+        self.threads = threads
+        # Number of processes drawing the plots
+        self.jobs = jobs
+        self.max_cache_bytes = max_cache_bytes
+        self.cache_dir = cache_dir
 
     def check_and_parse_conf(self):
         for name in list(self.conf.keys()):
@@ -82,20 +276,27 @@ class Validator:
             if not all([k in values for k in required]):
                 print(f'Error parsing configuration, at least one of the fields {required} not found in the configuration for {key}: {values}')
 
-    def run_validation(self):
-        self.check_and_parse_conf()
-
-        reader = Reader(self.conf)
-        reader.check_filenames()
-        rdfs = reader.get_rdfs()
+    def get_function(self, name):
+        """
+        Return the parsed expression of an entry, or None if the values of
+        the column are used as they are
+        """
+        functions = self.conf[name].get('function', 'do_nothing')
+        if functions == 'do_nothing':
+            return None
+        return parse_expression(functions)
 
-        allfuncs = globals().copy()
-        allfuncs.update(locals())
-
-        for name in self.conf:
-            print(f'Running validation for {name}')
-            filename = self.conf[name]['filename']
-            rdf = rdfs[filename]
+    def book(self, cache, names):
+        """
+        Book lazily what is needed by every entry, nothing is read until the
+        actions of all the RDataFrames are run together. Entries that can be
+        histogrammed in the event loop only need the range of their values
+        (unless given with 'range'), the others need their columns. Functions
+        are compiled to C++ and run in the event loop when possible, otherwise
+        they are evaluated with numpy on the columns.
+        """
+        booked = {}
+        for name in names:
             varls = self.conf[name]['var']
             if not isinstance(varls, list):
                 varls = [varls]
@@ -103,48 +304,196 @@ class Validator:
 
             if 'filter' in self.conf[name]:
                 print('Filtering with', self.conf[name]['filter'])
-            data = rdf.AsNumpy(varls) if 'filter' not in self.conf[name] else rdf.Filter(self.conf[name]['filter']).AsNumpy(varls)
-
-            # for col in data:
-            #     data[col] = np.concatenate([np.asarray(x) for x in data[col]])
-
-            data_ref = None
+            samples = {'new': cache.node(get_files(self.conf[name]['filename']), self.conf[name].get('filter'))}
             if 'reference' in self.conf[name]:
-                data_ref = rdfs[self.conf[name]['reference']].AsNumpy(varls)
-                for col in data_ref:
-                    data_ref[col] = np.concatenate([np.asarray(x) for x in data_ref[col]])
+                samples['ref'] = cache.node(get_files(self.conf[name]['reference']))
 
-            if 'function' in self.conf[name]:
-                functions = self.conf[name]['function']
-            else:
-                functions = 'do_nothing'
-            if functions in allfuncs:
-                func = allfuncs.get(functions)
+            func = self.get_function(name)
+            # Column histogrammed for each sample, the defined columns have a
+            # different name in each sample
+            var = {k: varls[0] for k in samples}
+            compiled = False
+            if func is not None:
+                defined = {k: cache.define(node, func, varls) for k, node in samples.items()}
+                if all(d is not None for d in defined.values()):
+                    samples = {k: node for k, (node, _) in defined.items()}
+                    var = {k: column for k, (_, column) in defined.items()}
+                    func = None
+                    compiled = True
+                else:
+                    print(f'Could not compile "{func.text}" for {name}, it will be evaluated with numpy')
+            if func is not None or len(varls) > 1 and not compiled:
+                booked[name] = {'func': func, 'samples': samples, 'columns': varls}
+                for node in samples.values():
+                    for col in varls:
+                        cache.book(node, 'Take', col)
+                continue
+            booked[name] = {'func': None, 'samples': samples, 'var': var}
+            if 'range' not in self.conf[name]:
+                for k, node in samples.items():
+                    cache.book(node, 'Min', var[k])
+                    cache.book(node, 'Max', var[k])
+        return booked
+
+    def book_histograms(self, cache, booked):
+        """
+        Book the histograms of the entries filled in the event loop, using the
+        same binning for the new and the reference samples
+        """
+        for name, entry in booked.items():
+            if 'var' not in entry:
+                continue
+            var = entry['var']
+            bins = self.conf[name].get('bins', 100)
+            if 'range' in self.conf[name]:
+                low, high = self.conf[name]['range']
             else:
-                func = eval(functions)
-            if 'plot' in self.conf[name]:
-                fig, ax = plt.subplots(1, 1, figsize=(3.72, 2.3))
-                if self.conf[name]['plot'] == 'hist':
-                    to_plot = func(*data.values())
-                    ax.hist(to_plot, bins=100, histtype='step', density=True)
-                    left = ['Mean', 'Std. Dev', 'Entries']
-                    right = f'{to_plot.mean():.2f} {to_plot.std():.2f} {len(to_plot)}'
-                    add_table(left, right, ax, [.45, .5, .25, .3], title='New')
-                    if data_ref:
-                        to_plot = func(*data_ref.values())
-                        ax.hist(to_plot, bins=100, histtype='step', density=True)
-                        right = f'{to_plot.mean():.2f} {to_plot.std():.2f} {len(to_plot)}'
-                        add_table(left, right, ax, [.70, .5, .25, .3], title='Ref')
-                    if 'xlabel' in self.conf[name]:
-                        ax.set_xlabel(self.conf[name]['xlabel'])
-                    if 'ylabel' in self.conf[name]:
-                        ax.set_ylabel(self.conf[name]['ylabel'])
-                    if 'xlim' in self.conf[name]:
-                        ax.set_xlim(self.conf[name]['xlim'])
-                    if 'ylim' in self.conf[name]:
-                        ax.set_ylim(self.conf[name]['ylim'])
-
-                    fig.savefig(f'{name}.png')
-
-
-Validator(conf).run_validation()
+                low = min(cache.book(node, 'Min', var[k]).GetValue() for k, node in entry['samples'].items())
+                high = max(cache.book(node, 'Max', var[k]).GetValue() for k, node in entry['samples'].items())
+                low, high = get_range(low, high)
+            entry['binning'] = (bins, float(low), float(high))
+            for k, node in entry['samples'].items():
+                cache.book(node, 'Histo1D', var[k], *entry['binning'])
+
+    def get_results(self, cache, name, entry):
+        """
+        Return the bin contents, bin edges, mean, standard deviation and number
+        of entries for each sample of an entry
+        """
+        results = {}
+        if 'var' in entry:
+            for k, node in entry['samples'].items():
+                h = cache.book(node, 'Histo1D', entry['var'][k], *entry['binning']).GetValue()
+                counts, edges = hist_to_numpy(h)
+                results[k] = (counts, edges, h.GetMean(), h.GetStdDev(), int(h.GetEntries()))
+            return results
+
+        func = entry['func'] if entry['func'] is not None else do_nothing
+        values = {k: np.asarray(func(*[cache.column(node, col) for col in entry['columns']]))
+                  for k, node in entry['samples'].items()}
+        if 'range' in self.conf[name]:
+            low, high = self.conf[name]['range']
+        else:
+            low, high = get_range(min(v.min() for v in values.values()), max(v.max() for v in values.values()))
+        edges = np.linspace(low, high, self.conf[name].get('bins', 100) + 1)
+        for k, v in values.items():
+            counts, _ = np.histogram(v, bins=edges)
+            results[k] = (counts, edges, v.mean(), v.std(), len(v))
+        return results
+
+    def cache_key(self, name):
+        """
+        Key of the results of an entry in the persistent cache. Only what
+        changes the histograms enters the key, cosmetic fields like labels or
+        limits of the axes do not
+        """
+        conf = self.conf[name]
+        key = {'version': CACHE_VERSION,
+               'new': [file_identity(f) for f in get_files(conf['filename'])],
+               'ref': [file_identity(f) for f in get_files(conf['reference'])] if 'reference' in conf else None,
+               'var': conf['var'],
+               'filter': conf.get('filter'),
+               'function': conf.get('function', 'do_nothing'),
+               'bins': conf.get('bins', 100),
+               'range': conf.get('range'),
+               }
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def compute_results(self, names):
+        """
+        Read the files and compute the results of the given entries
+        """
+        import ROOT
+
+        reader = Reader({name: self.conf[name] for name in names})
+        reader.check_filenames()
+        if self.threads != 1 and not ROOT.IsImplicitMTEnabled():
+            ROOT.EnableImplicitMT(self.threads)
+        cache = DataCache(reader.get_rdfs(), self.max_cache_bytes)
+
+        # Statistics are computed from all the values filled, not only the
+        # ones inside the range of the histogram
+        ROOT.TH1.StatOverflows(True)
+
+        booked = self.book(cache, names)
+        # A single event loop per file for all the entries, the loops over
+        # different files run concurrently. A second one is needed to fill
+        # the histograms once the ranges are known
+        if cache.pending():
+            ROOT.RDF.RunGraphs(cache.pending())
+        self.book_histograms(cache, booked)
+        if cache.pending():
+            ROOT.RDF.RunGraphs(cache.pending())
+
+        return {name: self.get_results(cache, name, entry) for name, entry in booked.items()}
+
+    def run_validation(self):
+        self.check_and_parse_conf()
+
+        all_results = {}
+        keys = {}
+        if self.cache_dir is not None:
+            for name in self.conf:
+                keys[name] = self.cache_key(name)
+                cached = load_results(self.cache_dir, keys[name])
+                if cached is not None:
+                    print(f'Using cached results for {name}')
+                    all_results[name] = cached
+        names = [name for name in self.conf if name not in all_results]
+        if names:
+            computed = self.compute_results(names)
+            if self.cache_dir is not None:
+                for name, results in computed.items():
+                    save_results(self.cache_dir, keys[name], results)
+            all_results.update(computed)
+
+        plots = []
+        for name in self.conf:
+            print(f'Running validation for {name}')
+            if self.conf[name].get('plot') != 'hist':
+                continue
+            plot = {'filename': f'{name}.png',
+                    'labels': ('New', 'Ref'),
+                    'tables': ([.45, .5, .25, .3], [.70, .5, .25, .3]),
+                    'legend': False,
+                    'ylabel': self.conf[name].get('ylabel', ''),
+                    }
+            for k, key in [('new', 'current'), ('ref', 'reference')]:
+                if k in all_results[name]:
+                    counts, edges, mean, std, entries = all_results[name][k]
+                    plot[key] = {'counts': counts, 'edges': edges, 'mean': mean, 'std': std, 'entries': entries}
+            for field in ['xlabel', 'xlim', 'ylim']:
+                if field in self.conf[name]:
+                    plot[field] = self.conf[name][field]
+            plots.append(plot)
+
+        if plots:
+            from matplotlib_utils import draw_hist_plots
+            from histogram_tests import check_plots
+            # The plots that fail any of the tests are made red
+            check_plots(plots)
+            # Plots are cached together with the results, when their content
+            # doesn't change they are not drawn again
+            render_cache = None if self.cache_dir is None else os.path.join(self.cache_dir, 'plots')
+            draw_hist_plots(plots, self.jobs, render_cache)
+
+
+def main(conf_file='conf.yaml', threads=0, cache_dir='.validation_cache', max_cache_bytes=2 * 1024**3, jobs=None):
+    try:
+        conf = load_conf(conf_file)
+    except yaml.YAMLError as exc:
+        print(exc)
+        return
+    Validator(conf, max_cache_bytes=max_cache_bytes, cache_dir=cache_dir, threads=threads, jobs=jobs).run_validation()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Make plots of the distributions described in a configuration file')
+    parser.add_argument('--conf', default='conf.yaml', help='Path to the configuration file')
+    parser.add_argument('--threads', type=int, default=0, help='Number of threads for the event loops, 0 uses all the cores and 1 disables multithreading')
+    parser.add_argument('--cache-dir', default='.validation_cache', help='Directory of the persistent cache of results')
+    parser.add_argument('--no-cache', action='store_true', help='Do not use the persistent cache of results')
+    parser.add_argument('--max-cache-size', type=float, default=2, help='Maximum size in GiB of the columns kept in memory')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of processes drawing the plots (default: number of cores)')
+    args = parser.parse_args()
+    main(args.conf, args.threads, None if args.no_cache else args.cache_dir, int(args.max_cache_size * 1024**3), args.jobs)
@@ -1,9 +1,10 @@
 # Make plots of jet variables from the jet study root file
+import awkward as ak
 import numpy as np
-import matplotlib.pyplot as plt
 import uproot
 import argparse
-from matplotlib_utils import add_table
+from matplotlib_utils import make_histogram, draw_hist_plots
+from histogram_tests import check_plots
 
 label_map = {'recoJetE': 'Reconstructed Jet Energy [GeV]',
              'recoJetPx': 'Reconstructed Jet $P_x$ [GeV]',
@@ -39,96 +40,71 @@ label_map = {'recoJetE': 'Reconstructed Jet Energy [GeV]',
              'd2_mcE': 'Daughter 2 MC Energy [GeV]',
              }
 
-# Number of sigmas away from the mean to make the plot red
-threshold = 3
 
-# x, y, width, height
-table_dimensions_left = [0.5, 0.7, 0.25, 0.2]
-table_dimensions_right = [0.75, 0.7, 0.25, 0.2]
+def flat(array):
+    """
+    All the values of a (possibly jagged) branch as a flat numpy array
+    """
+    return ak.to_numpy(ak.flatten(array, axis=None))
 
 
-def main(root_file, reference_root_file):
+def jet_difference(gen, reco):
+    """
+    Differences between generated and reconstructed jets, only for the events
+    that have the same number of both
+    """
+    same = ak.num(gen, axis=-1) == ak.num(reco, axis=-1)
+    return flat(gen[same] - reco[same])
+
+
+def main(root_file, reference_root_file, jobs=None, render_cache='.render_cache'):
     upr = uproot.open(root_file)['showerData;1']
     ref = uproot.open(reference_root_file)['showerData;1']
-    arrays = [upr.arrays(upr.keys(), library='np'), ref.arrays(ref.keys(), library='np')]
+    # Jagged branches are read as awkward arrays
+    arrays = [upr.arrays(upr.keys()), ref.arrays(ref.keys())]
     assert all(k in ref.keys() for k in upr.keys())
 
-    fig, ax = plt.subplots(1, 1, figsize=(3.72, 2.3))
-
-    for k in arrays[0].keys():
-        if arrays[0][k].dtype != object:
-            dist_current = arrays[0][k]
-            dist_reference = arrays[1][k]
-        else:
-            dist_current = np.concatenate(arrays[0][k])
-            dist_reference = np.concatenate(arrays[1][k])
+    plots = []
+    for k in arrays[0].fields:
+        dist_current = flat(arrays[0][k])
+        dist_reference = flat(arrays[1][k])
         if 'pdg' in k.lower():
-            bins = 'auto'
+            bins = np.histogram_bin_edges(dist_current, bins='auto')
         elif k == 'E_trueInv':
             bins = [-.5, .5]
         else:
             bins = np.linspace(min(dist_current.min(), dist_reference.min()), max(dist_current.max(), dist_reference.max()), 15)
-        _, bins, _ = ax.hist(dist_current, bins=bins, histtype='step', label='Current', density=True)
-        ax.hist(dist_reference, bins=bins, histtype='step', label='Reference', density=True)
-
-        left = ['Mean', 'Std. Dev.', 'Entries']
-        right_current_values = [dist_current.mean(), dist_current.std(), len(dist_current)]
-        right_current_labels = [f'{right_current_values[0]:.2f}', f'{right_current_values[1]:.2f}', f'{right_current_values[2]}']
-        add_table(left, right_current_labels, ax, table_dimensions_left, title='Current')
-        right_reference_values = [dist_reference.mean(), dist_reference.std(), len(dist_reference)]
-        right_reference_labels = [f'{right_reference_values[0]:.2f}', f'{right_reference_values[1]:.2f}', f'{right_reference_values[2]}']
-        add_table(left, right_reference_labels, ax, table_dimensions_right, title='Reference')
-
-        # If the mean is more than threshold sigma away from the reference, make the plot red
-        if abs(right_current_values[0] - right_reference_values[0]) > threshold*(right_reference_values[1] / np.sqrt(len(dist_reference))):
-            fig.patch.set_facecolor('red')
-
-        ax.legend()
-        ax.set_ylabel('Entries [a.u.]')
-        ax.set_xlabel(label_map[k])
-        ax.set_ylim(ax.get_ylim()[0], ax.get_ylim()[1]*1.2)
-        fig.savefig(f'jet-{k}.svg')
-        ax.clear()
-        fig.patch.set_facecolor('white')
+        current = make_histogram(dist_current, bins)
+        reference = make_histogram(dist_reference, current['edges'])
 
-        # if k == 'genJetE':
-        #     print(dist_current, dist_reference)
-        #     print(right_current_values, right_reference_values)
-        #     print(abs(right_current_values[0] - right_reference_values[0]), threshold*(right_reference_values[1] / np.sqrt(len(dist_reference))))
+        plots.append({'filename': f'jet-{k}.svg',
+                      'current': current,
+                      'reference': reference,
+                      'xlabel': label_map[k],
+                      })
 
     for gen, reco in [['genJetE', 'recoJetE'], ['genJetPx', 'recoJetPx'], ['genJetPy', 'recoJetPy'], ['genJetPz', 'recoJetPz']]:
-        dist_current = np.concatenate(arrays[0][gen])-np.concatenate(arrays[0][reco])
-        # Remove any array that doesn't have both the generated and reconstructed
-        for i in range(len(arrays[1][gen])):
-            if len(arrays[1][gen][i]) and len(arrays[1][gen][i]) != len(arrays[1][reco][i]):
-                arrays[1][gen][i] = np.array([])
-                arrays[1][reco][i] = np.array([])
-        dist_reference = np.concatenate(arrays[1][gen])-np.concatenate(arrays[1][reco])
-        _, bins, _ = ax.hist(dist_current, bins=20, histtype='step', label='Current', density=True)
-        ax.hist(dist_reference, bins=bins, histtype='step', label='Reference', density=True)
-        left = ['Mean', 'Std. Dev.', 'Entries']
-        right_current_values = [dist_current.mean(), dist_current.std(), len(dist_current)]
-        right_current_labels = [f'{right_current_values[0]:.2f}', f'{right_current_values[1]:.2f}', f'{right_current_values[2]}']
-        add_table(left, right_current_labels, ax, table_dimensions_left, title='Current')
-        right_reference_values = [dist_reference.mean(), dist_reference.std(), len(dist_reference)]
-        right_reference_labels = [f'{right_reference_values[0]:.2f}', f'{right_reference_values[1]:.2f}', f'{right_reference_values[2]}']
-        add_table(left, right_reference_labels, ax, table_dimensions_right, title='Reference')
+        dist_current, dist_reference = [jet_difference(a[gen], a[reco]) for a in arrays]
+        current = make_histogram(dist_current, 20)
+        reference = make_histogram(dist_reference, current['edges'])
 
-        # If the mean is more than threshold sigma away from the reference, make the plot red
-        if abs(right_current_values[0] - right_reference_values[0]) > threshold*(right_reference_values[1] / np.sqrt(len(dist_reference))):
-            fig.patch.set_facecolor('red')
+        plots.append({'filename': f'jet-{gen}-{reco}.svg',
+                      'current': current,
+                      'reference': reference,
+                      'xlabel': f'{label_map[gen]} - {label_map[reco]}',
+                      })
 
-        ax.legend()
-        ax.set_xlabel(f'{label_map[gen]} - {label_map[reco]}')
-        ax.set_ylabel('Entries [a.u.]')
-        ax.set_ylim(ax.get_ylim()[0], ax.get_ylim()[1]*1.2)
-        fig.savefig(f'jet-{gen}-{reco}.svg')
-        ax.clear()
+    # The plots that fail any of the tests are made red
+    check_plots(plots)
+    draw_hist_plots(plots, jobs, render_cache)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Make plots of jet variables from the jet study root file')
     parser.add_argument('root_file', help='Path to the root file')
     parser.add_argument('reference_root_file', help='Path to the reference root file')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of processes drawing the plots (default: number of cores)')
+    parser.add_argument('--render-cache', default='.render_cache', help='Directory with the plots already drawn, reused when their content does not change')
+    parser.add_argument('--no-render-cache', action='store_true', help='Draw all the plots')
     args = parser.parse_args()
-    main(args.root_file, args.reference_root_file)
+    main(args.root_file, args.reference_root_file, args.jobs, None if args.no_render_cache else args.render_cache)
@@ -1,38 +1,124 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import uproot
 import argparse
+from collections import defaultdict
+from matplotlib.figure import Figure
 
-parser = argparse.ArgumentParser(description='Make plots of jet variables from the jet study root file')
-parser.add_argument('root_file', help='Path to the root file')
-parser.add_argument('reference_root_file', help='Path to the reference root file')
-args = parser.parse_args()
-
-upr = uproot.open(args.root_file)
-ref = uproot.open(args.reference_root_file)
-assert all(k in ref.keys() for k in upr.keys())
-
-i = 0
-while i < len(upr.keys()):
-    if 'eff_vs' in upr.keys()[i] or 'fake_vs' in upr.keys()[i] or 'dupl_vs' in upr.keys()[i]:
-        passed = upr[upr.keys()[i]].to_numpy()
-        total = upr[upr.keys()[i+1]].to_numpy()
-        passed_ref = ref[ref.keys()[i]].to_numpy()
-        total_ref = ref[ref.keys()[i+1]].to_numpy()
-        bins = passed[1]
-        values = np.nan_to_num((passed[0]/total[0]).astype(np.float64))
-        values_ref = np.nan_to_num((passed_ref[0]/total_ref[0]).astype(np.float64))
-        xlabel = '_'.join(upr.keys()[i].split('_')[:-1])
-        i += 2
-    else:
-        xlabel = upr.keys()[i]
-        values, bins = upr[upr.keys()[i]].to_numpy()
-        values_ref, bins_ref = ref[ref.keys()[i]].to_numpy()
-        i += 1
-    central = (bins[1:] + bins[:-1])/2
-    fig, ax = plt.subplots(1, 1, figsize=(3.72, 2.3))
-    ax.plot(central, values, 'o', label='Current')
-    ax.plot(central, values_ref, 's', label='Reference')
-    ax.set_xlabel(xlabel)
-    ax.legend()
-    fig.savefig(f'tracking-{xlabel}.png')
+# Histograms with these names come in pairs (passed and total) from which an
+# efficiency or rate is computed
+ratio_names = ['eff_vs', 'fake_vs', 'dupl_vs']
+
+# Number of sigmas of the Wilson intervals drawn as error bars
+z = 1
+
+
+def read_histograms(file):
+    """
+    Read all the 1D histograms of a file in one pass, returns a dictionary of
+    name (without cycle) to (counts, edges)
+    """
+    return {name.split(';')[0]: file[name].to_numpy()
+            for name, classname in file.classnames().items() if classname.startswith('TH1')}
+
+
+def pair_histograms(names):
+    """
+    Group the passed and total histograms of each efficiency by name: they
+    share the name up to the last '_' and, as written by the tracking
+    validation, the passed one comes first in the file. Returns the pairs as
+    a dictionary of efficiency name to the passed and total histogram names
+    and the names of the histograms that are plotted alone
+    """
+    groups = defaultdict(list)
+    single = []
+    for name in names:
+        if any(ratio in name for ratio in ratio_names):
+            groups['_'.join(name.split('_')[:-1])].append(name)
+        else:
+            single.append(name)
+    pairs = {}
+    for name, members in groups.items():
+        if len(members) != 2:
+            raise ValueError(f'Could not find the passed and total histograms for {name}, found {members}')
+        pairs[name] = members
+    return pairs, single
+
+
+def stack(hists):
+    """
+    Stack the counts of histograms into a 2D array, padding with empty bins
+    """
+    nbins = max(len(counts) for counts, _ in hists)
+    stacked = np.zeros((len(hists), nbins))
+    for i, (counts, _) in enumerate(hists):
+        stacked[i, :len(counts)] = counts
+    return stacked
+
+
+def efficiencies(passed, total, names=None):
+    """
+    Efficiencies and the lower and upper errors from Wilson score intervals,
+    for all the pairs of stacked passed and total histograms at once. Pairs
+    with more passed than total entries in any bin are an error
+    """
+    wrong = np.flatnonzero((passed > total).any(axis=1)).tolist()
+    if wrong:
+        if names is not None:
+            wrong = [names[i] for i in wrong]
+        raise ValueError(f'More passed than total entries in {wrong}, the passed histogram has to come first')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eff = passed / total
+        denominator = 1 + z**2 / total
+        center = (eff + z**2 / (2 * total)) / denominator
+        half_width = z * np.sqrt(eff * (1 - eff) / total + z**2 / (4 * total**2)) / denominator
+    # Bins without entries are shown as 0 without errors
+    empty = total == 0
+    eff = np.where(empty, 0, eff)
+    low = np.where(empty, 0, eff - (center - half_width))
+    high = np.where(empty, 0, center + half_width - eff)
+    return eff, np.clip(low, 0, None), np.clip(high, 0, None)
+
+
+def main(root_file, reference_root_file):
+    hists = read_histograms(uproot.open(root_file))
+    hists_ref = read_histograms(uproot.open(reference_root_file))
+    assert all(k in hists_ref for k in hists)
+
+    pairs, single = pair_histograms(hists.keys())
+    plots = []
+    if pairs:
+        names = list(pairs)
+        # All the efficiencies are computed at once, one row per histogram
+        passed = [hists[pairs[name][0]] for name in names]
+        total = [hists[pairs[name][1]] for name in names]
+        current = efficiencies(stack(passed), stack(total), names)
+        reference = efficiencies(stack([hists_ref[pairs[name][0]] for name in names]),
+                                 stack([hists_ref[pairs[name][1]] for name in names]), names)
+        for i, name in enumerate(names):
+            bins = passed[i][1]
+            nbins = len(bins) - 1
+            plots.append((name, bins,
+                          [values[i, :nbins] for values in current],
+                          [values[i, :nbins] for values in reference]))
+    for name in single:
+        values, bins = hists[name]
+        values_ref, _ = hists_ref[name]
+        plots.append((name, bins, [values, None, None], [values_ref, None, None]))
+
+    for xlabel, bins, (values, low, high), (values_ref, low_ref, high_ref) in plots:
+        central = (bins[1:] + bins[:-1])/2
+        fig = Figure(figsize=(3.72, 2.3))
+        ax = fig.add_subplot(1, 1, 1)
+        ax.errorbar(central, values, yerr=None if low is None else [low, high], fmt='o', label='Current')
+        ax.errorbar(central, values_ref, yerr=None if low_ref is None else [low_ref, high_ref], fmt='s', label='Reference')
+        ax.set_xlabel(xlabel)
+        ax.legend()
+        fig.savefig(f'tracking-{xlabel}.png')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Make plots of jet variables from the jet study root file')
+    parser.add_argument('root_file', help='Path to the root file')
+    parser.add_argument('reference_root_file', help='Path to the reference root file')
+    args = parser.parse_args()
+    main(args.root_file, args.reference_root_file)
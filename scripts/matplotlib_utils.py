@@ -1,42 +1,238 @@
-from matplotlib.table import Table
-from matplotlib.patches import Rectangle
-
-
-def add_table(left, right, ax, pos, title=None):
-    # left bottom width height
-    l, b, w, h = pos
-    rec = Rectangle((l, b), w, h, fc='w', ec='k', fill=True,
-                    transform=ax.transAxes, zorder=11)
-
-    if not isinstance(left, list):
-        left = left.split(' ')
-    if not isinstance(right, list):
-        right = right.split(' ')
-    if len(left) != len(right):
-        print(left, right)
-        raise ValueError('Length of left and right have to be the same')
-
-    tb = Table(ax, bbox=pos, zorder=12, transform=ax.transAxes)
-    width_cell, height_cell = 1, 1 / 3
-    for i in range(len(left)):
-        tb.add_cell(i, 0, width_cell, height_cell, text=left[i], loc='left')
-        tb.add_cell(i, 1, width_cell, height_cell, text=right[i],
-                    loc='right')
-        tb.get_celld()[(i, 0)].visible_edges = ''
-        tb.get_celld()[(i, 1)].visible_edges = ''
-        # tb.auto_set_column_width((0, 1))
-        tb.auto_set_font_size(False)
-        tb.set_fontsize(8)
-
-        # tb.get_celld()[(-1, -1)].visible_edges = 'LTR'
-        # tb.get_celld()[(-1, -1)].set_bounds(0, 0, 2, 2)
-        if title:
+import hashlib
+import os
+import shutil
+from importlib.metadata import version
+from multiprocessing import Pool
+
+import numpy as np
+
+# matplotlib is imported only when something is drawn, so that plots restored
+# from the render cache don't pay for it
+
+# Increase when the way plots are drawn changes, to invalidate the render cache
+STYLE_VERSION = 2
+
+
+# x, y, width, height
+table_dimensions_left = [0.5, 0.7, 0.25, 0.2]
+table_dimensions_right = [0.75, 0.7, 0.25, 0.2]
+
+figsize = (3.72, 2.3)
+
+
+def make_histogram(values, bins):
+    """
+    Histogram a distribution with the given bins (edges, number of bins or a
+    numpy binning method) and compute its statistics
+    """
+    values = np.asarray(values)
+    counts, edges = np.histogram(values, bins=bins)
+    return {'counts': counts, 'edges': edges,
+            'mean': values.mean(), 'std': values.std(), 'entries': len(values)}
+
+
+def density(counts, edges):
+    """
+    Normalize the bin contents so that the histogram integrates to one
+    """
+    total = counts.sum()
+    if not total:
+        return counts.astype(float)
+    return counts / (total * np.diff(edges))
+
+
+class HistPlotTemplate:
+    """
+    Figure for plots with precomputed histograms (see draw_hist_plot). The
+    artists that are the same for all the plots with the same labels, table
+    positions and legend (axes, table frames, titles and row labels, legend)
+    are created once; for each plot only the histograms, the statistics, the
+    axis labels and the limits are updated.
+    The tables of statistics are made of plain text artists at fixed
+    positions, that are much cheaper to draw than a matplotlib Table, which
+    lays out all its cells again every time it is drawn
+    """
+    stats = ['Mean', 'Std. Dev.', 'Entries']
+    # Padding of the text in the cells, as a fraction of the cell width
+    pad = 0.1
+
+    def __init__(self, labels, tables, legend):
+        from matplotlib.figure import Figure
+        from matplotlib.patches import Rectangle
+
+        self.fig = Figure(figsize=figsize)
+        self.ax = ax = self.fig.add_subplot(1, 1, 1)
+        self.steps = []
+        self.tables = []
+        for label, pos in zip(labels, tables):
+            self.steps.append(ax.stairs([0], [0, 1], label=label))
+            l, b, w, h = pos
+            ax.add_artist(Rectangle((l, b), w, h, fc='w', ec='k', fill=True,
+                                    transform=ax.transAxes, zorder=11))
             ax.add_patch(Rectangle((l, b + h), w, h / 3, fill=False, transform=ax.transAxes,
                                    zorder=3, facecolor='w'))
-            ax.text(l + w / 2, b + 1.1 * h, title,
+            ax.text(l + w / 2, b + 1.1 * h, label,
                     transform=ax.transAxes, horizontalalignment='center',
                     weight='bold', fontsize='x-small')
+            cells = []
+            for i, stat in enumerate(self.stats):
+                y = b + h * (1 - (i + 0.5) / len(self.stats))
+                ax.text(l + self.pad * w / 2, y, stat, transform=ax.transAxes, fontsize=8,
+                        horizontalalignment='left', verticalalignment='center', zorder=12)
+                cells.append(ax.text(l + w - self.pad * w / 2, y, '', transform=ax.transAxes, fontsize=8,
+                                     horizontalalignment='right', verticalalignment='center', zorder=12))
+            self.tables.append(cells)
+        if legend:
+            ax.legend()
+
+    def draw(self, plot):
+        ax = self.ax
+        for key, step, cells in zip(['current', 'reference'], self.steps, self.tables):
+            hist = plot.get(key)
+            step.set_visible(hist is not None)
+            if hist is None:
+                for cell in cells:
+                    cell.set_text('')
+                continue
+            step.set_data(density(hist['counts'], hist['edges']), hist['edges'])
+            for cell, value in zip(cells, [f"{hist['mean']:.2f}", f"{hist['std']:.2f}", f"{hist['entries']}"]):
+                cell.set_text(value)
+
+        self.fig.patch.set_facecolor('red' if plot.get('alert') else 'white')
+        ax.set_ylabel(plot.get('ylabel', 'Entries [a.u.]'))
+        ax.set_xlabel(plot.get('xlabel', ''))
+        ax.set_autoscale_on(True)
+        ax.relim(visible_only=True)
+        ax.autoscale_view()
+        if 'xlim' in plot:
+            ax.set_xlim(plot['xlim'])
+        if 'ylim' in plot:
+            ax.set_ylim(plot['ylim'])
+        else:
+            ax.set_ylim(ax.get_ylim()[0], ax.get_ylim()[1]*1.2)
+        self.fig.savefig(plot['filename'])
+
+
+def template_key(plot):
+    labels = plot.get('labels', ('Current', 'Reference'))
+    tables = plot.get('tables', (table_dimensions_left, table_dimensions_right))
+    return tuple(labels), tuple(tuple(pos) for pos in tables), bool(plot.get('legend', True))
+
+
+def draw_hist_plot(plot, templates=None):
+    """
+    Draw a plot with precomputed histograms. plot is a dictionary with
+        filename: where to save the plot
+        current, reference: histograms made with make_histogram (reference is optional)
+        xlabel, ylabel, xlim, ylim (optional)
+        alert: make the background red
+        labels: labels of the current and reference histograms
+        tables: positions of the tables with the statistics
+        legend: whether to draw the legend
+    templates is a dictionary where the figure templates are kept to be
+    reused by the next plots
+    """
+    templates = {} if templates is None else templates
+    key = template_key(plot)
+    if key not in templates:
+        templates[key] = HistPlotTemplate(*key)
+    templates[key].draw(plot)
+
+
+def _draw_hist_plots(plots):
+    # The figures are created once and reused for all the plots
+    templates = {}
+    for plot in plots:
+        draw_hist_plot(plot, templates)
+    return len(plots)
+
+
+def _update_hash(h, value):
+    if isinstance(value, dict):
+        h.update(b'{')
+        for k in sorted(value):
+            h.update(repr(k).encode())
+            _update_hash(h, value[k])
+        h.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        h.update(b'[')
+        for v in value:
+            _update_hash(h, v)
+        h.update(b']')
+    elif isinstance(value, np.ndarray):
+        h.update(f'{value.dtype}{value.shape}'.encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, np.generic):
+        h.update(repr(value.item()).encode())
+    else:
+        h.update(repr(value).encode())
+
+
+def render_key(plot):
+    """
+    Hash of everything that changes how a plot looks: the histograms, labels
+    and options, the file format and the version of the style and of
+    matplotlib
+    """
+    h = hashlib.sha1()
+    content = {k: v for k, v in plot.items() if k != 'filename'}
+    _update_hash(h, [STYLE_VERSION, version('matplotlib'),
+                     os.path.splitext(plot['filename'])[1], content])
+    return h.hexdigest()
+
+
+def _link_or_copy(source, destination):
+    """
+    Hard link source to destination, copying when linking is not possible
+    (e.g. different filesystems). destination is replaced atomically
+    """
+    # Renaming onto a link to the same file does nothing and would leave the
+    # temporary file behind
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+    tmp = f'{destination}.{os.getpid()}.tmp'
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, destination)
+
+
+def draw_hist_plots(plots, jobs=None, cache_dir='.render_cache'):
+    """
+    Draw a batch of plots (see draw_hist_plot), splitting them between jobs
+    processes (by default as many as cores). Plots that were already drawn
+    with the same content are taken from cache_dir without drawing them
+    again; cache_dir=None disables the cache
+    """
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        keys = {plot['filename']: render_key(plot) for plot in plots}
+        missing = []
+        for plot in plots:
+            cached = os.path.join(cache_dir, keys[plot['filename']] + os.path.splitext(plot['filename'])[1])
+            if os.path.exists(cached):
+                _link_or_copy(cached, plot['filename'])
+            else:
+                # The file may be a link to a cached plot, that would be
+                # overwritten when drawing
+                if os.path.exists(plot['filename']):
+                    os.remove(plot['filename'])
+                missing.append(plot)
+        print(f'Restored {len(plots) - len(missing)} plots from {cache_dir}, drawing {len(missing)}')
+        plots = missing
+
+    if plots:
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        jobs = max(1, min(jobs, len(plots)))
+        if jobs == 1:
+            _draw_hist_plots(plots)
+        else:
+            with Pool(jobs) as pool:
+                pool.map(_draw_hist_plots, [plots[i::jobs] for i in range(jobs)])
 
-    # Add rectangle and table
-    ax.add_artist(rec)
-    ax.add_table(tb)
+    if cache_dir is not None:
+        for plot in plots:
+            cached = os.path.join(cache_dir, keys[plot['filename']] + os.path.splitext(plot['filename'])[1])
+            _link_or_copy(plot['filename'], cached)
@@ -1,6 +1,15 @@
 import argparse
+import os
+import random
+from multiprocessing import Pool
+
+import numpy as np
+import yaml
 from podio.root_io import Reader, Writer
 
+# ROOT and uproot are only needed by the columnar path and the campaigns, they
+# are imported where they are used
+
 def parse_args():
     """
     Parse command-line arguments for modifying EDM4hep output file.
@@ -18,10 +27,16 @@ def parse_args():
     parser.add_argument("--offset", type=float, default=0.0, help="Offset to add to the scaled value")
     parser.add_argument("--set-val", type=float, default=None, help="Value to set instead of scaling")
 
+    parser.add_argument("--columnar", action="store_true", help="Rewrite only the branch of the modified collection instead of cloning it into a new _modified collection. The other branches are copied without decompressing them, but the collection branch is refilled event by event, so it still takes a loop over all the events")
+    parser.add_argument("--campaign", default=None, help="YAML file with a campaign of modifications, each one producing its own output file")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of processes used to write the campaign outputs")
+
     return parser.parse_args()
 
-if __name__ == "__main__":
-    args = parse_args()
+def modify_output(args):
+    """
+    Apply a single modification given on the command line and write the output file.
+    """
     reader = Reader(args.input_file)
     frame = args.frame
     if frame < 0 or frame >= len(reader.get('events')):
@@ -66,3 +81,305 @@ if __name__ == "__main__":
         else:
             for item in reader.get(category):
                 writer.write_frame(item, category)
+
+def get_member_branch(tree, collection_name, member):
+    """
+    Find the branch of a member of a collection in the events tree. Members
+    are stored with the name of the getter without 'get' and with the first
+    letter lowercase (e.g. getMass -> mass, getEDep -> eDep), except for the
+    ones that are all uppercase like PDG.
+    """
+    for field in (member[0].lower() + member[1:], member):
+        name = f'{collection_name}/{collection_name}.{field}'
+        if name in tree:
+            return field, tree[name]
+    raise ValueError(f'Member {member} not found in collection {collection_name}, only members that are not vectors can be modified with --columnar')
+
+def get_columnar_changes(input_file, collection_name, member, frames, hits, set_val=None, scale=1.0, offset=0.0):
+    """
+    Compute the new values for the modified hits reading only the branch of
+    the member in the frames to be modified. hits is a function returning
+    the indices to modify given the frame and the number of hits in it.
+    """
+    import uproot
+
+    changes = {}
+    with uproot.open(input_file) as f:
+        field, branch = get_member_branch(f['events'], collection_name, member)
+        for frame in frames:
+            values = branch.array(library='np', entry_start=frame, entry_stop=frame + 1)[0]
+            indices = np.asarray(hits(frame, len(values)), dtype=np.int64)
+            if not indices.size:
+                continue
+            if set_val is not None:
+                new_values = np.full(indices.size, set_val, dtype=values.dtype)
+            else:
+                new_values = (values[indices] * scale + offset).astype(values.dtype)
+            changes[frame] = {'hits': indices, 'old': values[indices], 'new': new_values}
+    return field, changes
+
+def write_columnar(input_file, output_file, collection_name, field, changes):
+    """
+    Write a copy of the input file where only the branch of the modified
+    collection is rewritten. All the other branches and trees are copied
+    basket by basket, without decompressing them. The collection branch is
+    filled again event by event from python, so this costs a loop over all
+    the events, not only a copy of the file.
+    """
+    import ROOT
+
+    in_file = ROOT.TFile.Open(input_file)
+    # A second handle to read the collection, the first one shares its
+    # branch addresses with the cloned tree
+    read_file = ROOT.TFile.Open(input_file)
+    out_file = ROOT.TFile(output_file, 'RECREATE')
+
+    names = list(dict.fromkeys(key.GetName() for key in in_file.GetListOfKeys()))
+    for name in names:
+        obj = in_file.Get(name)
+        if not obj.InheritsFrom('TTree'):
+            out_file.WriteObject(obj, name)
+            continue
+        if name != 'events':
+            out_file.cd()
+            obj.CloneTree(-1, 'fast').Write()
+            continue
+
+        obj.SetBranchStatus(collection_name, 0)
+        obj.SetBranchStatus(f'{collection_name}.*', 0)
+        out_file.cd()
+        out_tree = obj.CloneTree(-1, 'fast')
+
+        read_tree = read_file.Get(name)
+        read_tree.SetBranchStatus('*', 0)
+        read_tree.SetBranchStatus(collection_name, 1)
+        read_tree.SetBranchStatus(f'{collection_name}.*', 1)
+        # e.g. vector<edm4hep::MCParticleData>
+        data_type = read_tree.GetBranch(collection_name).GetClassName()
+        values = ROOT.std.vector[data_type[len('vector<'):-1]]()
+        branch = out_tree.Branch(collection_name, values)
+        for n_event in range(read_tree.GetEntries()):
+            read_tree.GetEntry(n_event)
+            original = getattr(read_tree, collection_name)
+            values.assign(original.begin(), original.end())
+            if n_event in changes:
+                for hit, new_val in zip(changes[n_event]['hits'].tolist(), changes[n_event]['new'].tolist()):
+                    setattr(values[hit], field, new_val)
+            branch.Fill()
+        out_tree.Write()
+
+    out_file.Close()
+    read_file.Close()
+    in_file.Close()
+
+def modify_output_columnar(args):
+    """
+    Apply a single modification given on the command line rewriting only the
+    branch of the modified collection.
+    """
+    import uproot
+
+    with uproot.open(args.input_file) as f:
+        n_events = f['events'].num_entries
+    if args.frame < 0 or args.frame >= n_events:
+        raise ValueError(f"Frame {args.frame} is out of bounds for the number of events in the input file.")
+
+    def hits(frame, n_hits):
+        if args.hit < 0 or args.hit >= n_hits:
+            raise IndexError(f'Hit {args.hit} is out of bounds for {args.collection_name} in frame {frame} with {n_hits} hits')
+        return [args.hit]
+
+    field, changes = get_columnar_changes(args.input_file, args.collection_name, args.member, [args.frame], hits,
+                                          args.set_val, args.scale, args.offset)
+    change = changes[args.frame]
+    print(f'Changing {args.collection_name}[{args.hit}]\'s {args.member.lower()} from {change["old"][0]} to {change["new"][0]}')
+    write_columnar(args.input_file, args.output_file, args.collection_name, field, changes)
+
+def load_campaign(campaign_file):
+    """
+    Read a campaign file and fill in the defaults of every modification.
+    """
+    with open(campaign_file, 'r') as f:
+        campaign = yaml.load(f, Loader=yaml.FullLoader)
+
+    output_dir = campaign.get('output-dir', '.')
+    modifications = []
+    for n, mod in enumerate(campaign['modifications']):
+        mod = dict(mod)
+        if 'collection' not in mod or 'member' not in mod:
+            raise ValueError(f'Modification {n} in {campaign_file} needs at least a collection and a member')
+        mod.setdefault('name', f'mod{n}')
+        mod.setdefault('seed', campaign.get('seed', 0) + n)
+        mod.setdefault('frames', 1)
+        mod.setdefault('hits', 1)
+        mod.setdefault('scale', 1.5)
+        mod.setdefault('offset', 0.0)
+        mod.setdefault('set-val', None)
+        mod.setdefault('output-file', os.path.join(output_dir, f"{mod['name']}.edm4hep.root"))
+        modifications.append(mod)
+    names = [mod['name'] for mod in modifications]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Modification names in {campaign_file} have to be unique: {names}')
+
+    campaign['modifications'] = modifications
+    campaign.setdefault('manifest', os.path.join(output_dir, 'manifest.yaml'))
+    return campaign
+
+def choose_frames(mod, n_events):
+    """
+    Pick the frames to modify: either the explicit list given in the campaign
+    or a number of them drawn with the seed of the modification.
+    """
+    if isinstance(mod['frames'], list):
+        frames = mod['frames']
+    else:
+        rng = random.Random(mod['seed'])
+        frames = rng.sample(range(n_events), min(mod['frames'], n_events))
+    for frame in frames:
+        if frame < 0 or frame >= n_events:
+            raise ValueError(f"Frame {frame} of modification {mod['name']} is out of bounds for the number of events in the input file.")
+    return sorted(set(frames))
+
+def choose_hits(mod, frame, n_hits):
+    """
+    Pick the hits to modify in a frame. The random generator is seeded with
+    both the seed of the modification and the frame, so that the choice does
+    not depend on how the campaign is split between processes. Explicit hits
+    have to exist in every modified frame.
+    """
+    if isinstance(mod['hits'], list):
+        for hit in mod['hits']:
+            if hit < 0 or hit >= n_hits:
+                raise IndexError(f"Hit {hit} of modification {mod['name']} is out of bounds for {mod['collection']} in frame {frame} with {n_hits} hits")
+        return sorted(set(mod['hits']))
+    rng = random.Random(f"{mod['seed']}:{frame}")
+    return sorted(rng.sample(range(n_hits), min(mod['hits'], n_hits)))
+
+def run_modifications(input_file, modifications, n_events):
+    """
+    Produce the output of every modification in a single pass over the input file.
+    Each modification gets its own copy of the collection in the frame, named
+    <collection>_modified_<name>, and only that copy is written to its output file.
+    """
+    reader = Reader(input_file)
+    frames = {mod['name']: set(choose_frames(mod, n_events)) for mod in modifications}
+    writers = {}
+    collections = {}
+    changes = {mod['name']: [] for mod in modifications}
+
+    for n_event, event in enumerate(reader.get('events')):
+        available = [str(c) for c in event.getAvailableCollections()]
+        for mod in modifications:
+            name = mod['name']
+            collection_name = mod['collection']
+            member = mod['member']
+            old_coll = event.get(collection_name)
+            hits = choose_hits(mod, n_event, len(old_coll)) if n_event in frames[name] else []
+            new_coll = type(old_coll)()
+            for n, elem in enumerate(old_coll):
+                new_elem = elem.clone()
+                if n in hits:
+                    current_val = getattr(elem, f'get{member}')()
+                    if mod['set-val'] is not None:
+                        new_val = mod['set-val']
+                    else:
+                        new_val = current_val * mod['scale'] + mod['offset']
+                    getattr(new_elem, f'set{member}')(new_val)
+                    changes[name].append({'frame': n_event, 'hit': n, 'old': float(current_val), 'new': float(new_val)})
+                new_coll.push_back(new_elem)
+            modified_name = f'{collection_name}_modified_{name}'
+            event.put(new_coll, modified_name)
+            if name not in writers:
+                os.makedirs(os.path.dirname(os.path.abspath(mod['output-file'])), exist_ok=True)
+                writers[name] = Writer(mod['output-file'])
+                collections[name] = available + [modified_name]
+            writers[name].write_frame(event, 'events', collections[name])
+
+    for category in reader.categories:
+        if category == 'events':
+            continue
+        for item in reader.get(category):
+            for writer in writers.values():
+                writer.write_frame(item, category)
+    # Close the files before returning to the parent process
+    writers.clear()
+
+    return changes
+
+def _run_modifications(task):
+    return run_modifications(*task)
+
+def run_modification_columnar(input_file, mod, n_events):
+    """
+    Produce the output of one modification rewriting only the branch of the
+    modified collection.
+    """
+    frames = choose_frames(mod, n_events)
+    field, changes = get_columnar_changes(input_file, mod['collection'], mod['member'], frames,
+                                          lambda frame, n_hits: choose_hits(mod, frame, n_hits),
+                                          mod['set-val'], mod['scale'], mod['offset'])
+    os.makedirs(os.path.dirname(os.path.abspath(mod['output-file'])), exist_ok=True)
+    write_columnar(input_file, mod['output-file'], mod['collection'], field, changes)
+    records = []
+    for frame, change in sorted(changes.items()):
+        for hit, old, new in zip(change['hits'].tolist(), change['old'].tolist(), change['new'].tolist()):
+            records.append({'frame': frame, 'hit': hit, 'old': float(old), 'new': float(new)})
+    return {mod['name']: records}
+
+def _run_modification_columnar(task):
+    return run_modification_columnar(*task)
+
+def run_campaign(campaign_file, input_file, jobs=1, columnar=False):
+    """
+    Run all the modifications of a campaign and write a manifest with the
+    differences that the comparison is expected to find in every output.
+    The modifications are split between the processes so that each one reads
+    the input file only once. With columnar, every output is an independent
+    copy of the input file and they are all written in parallel.
+    """
+    import uproot
+
+    campaign = load_campaign(campaign_file)
+    modifications = campaign['modifications']
+    with uproot.open(input_file) as f:
+        n_events = f['events'].num_entries
+
+    if columnar:
+        func = _run_modification_columnar
+        tasks = [(input_file, mod, n_events) for mod in modifications]
+    else:
+        func = _run_modifications
+        jobs = max(1, min(jobs, len(modifications)))
+        tasks = [(input_file, modifications[i::jobs], n_events) for i in range(jobs)]
+    if jobs == 1:
+        results = [func(task) for task in tasks]
+    else:
+        with Pool(jobs) as pool:
+            results = pool.map(func, tasks)
+    changes = {}
+    for result in results:
+        changes.update(result)
+
+    manifest = {'input-file': input_file, 'outputs': []}
+    for mod in modifications:
+        print(f"Modification {mod['name']}: {len(changes[mod['name']])} hits of {mod['collection']} changed, written to {mod['output-file']}")
+        manifest['outputs'].append({
+            'name': mod['name'],
+            'output-file': mod['output-file'],
+            'collection': mod['collection'],
+            'member': mod['member'],
+            'seed': mod['seed'],
+            'changes': changes[mod['name']],
+        })
+    with open(campaign['manifest'], 'w') as f:
+        yaml.dump(manifest, f, sort_keys=False)
+    print(f"Manifest written to {campaign['manifest']}")
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.campaign is not None:
+        run_campaign(args.campaign, args.input_file, args.jobs, args.columnar)
+    elif args.columnar:
+        modify_output_columnar(args)
+    else:
+        modify_output(args)
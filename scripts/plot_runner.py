@@ -1,19 +1,37 @@
 # Run all the plotting scripts and move the output to the correct folder
 # Expects the current plots to be in the current directory while the reference
 # plots are in the directory passed with --reference
+# Tasks run in parallel (-j), each in its own temporary working directory,
+# respecting the dependencies between them
+#
+# Many small jobs can be sent to a persistent worker that keeps the plotting
+# modules imported:
+#     python plot_runner.py --serve /tmp/plot_runner.sock &
+#     python plot_runner.py jets hists --reference ref --output out --socket /tmp/plot_runner.sock
+#     python plot_runner.py --stop --socket /tmp/plot_runner.sock
 
 import argparse
+import ast
+import contextlib
+import hashlib
 import importlib
+import importlib.util
+import inspect
+import json
+import multiprocessing
+import multiprocessing.connection
 import os
 import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
 import logging
 
-arg_parser = argparse.ArgumentParser()
-arg_parser.add_argument('plots', nargs='+')
-arg_parser.add_argument('--reference', required=True)
-arg_parser.add_argument('--output', required=True)
-arg_parser.add_argument('--debug', action='store_true')
-args = arg_parser.parse_args()
+import yaml
+
+import resource_usage
 
 # Mapping between arguments and which modules to run
 modules = {'jets': 'make_jet_plots',
@@ -25,32 +43,416 @@ filenames = {'jets': 'jet_study.root',
              'hists': 'histograms.root',
              }
 
-if args.debug:
-    logging.basicConfig(level=logging.DEBUG)
-else:
-    logging.basicConfig(level=logging.INFO)
+# Tasks that have to finish successfully before a task can start
+dependencies = {}
+
+# Increase when the way tasks are run changes, so that all of them run again
+MANIFEST_VERSION = 1
+
+
+def file_hash(path, block=1024**2):
+    """
+    sha256 of the content of a file
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(block):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def module_sources(module):
+    """
+    Source files of a module and of the modules next to it that it imports,
+    directly or not
+    """
+    sources = []
+    to_visit = [module]
+    while to_visit:
+        spec = importlib.util.find_spec(to_visit.pop())
+        if spec is None or spec.origin is None or not spec.origin.endswith('.py'):
+            continue
+        if spec.origin in sources or os.path.dirname(spec.origin) != os.path.dirname(os.path.abspath(__file__)):
+            continue
+        sources.append(spec.origin)
+        with open(spec.origin) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                to_visit.extend(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                to_visit.append(node.module)
+    return sorted(sources)
+
+
+def task_manifest(name, reference, input_dir):
+    """
+    What the outputs of a task depend on: the content of the input files,
+    the source of the plotting module and the arguments
+    """
+    inputs = [os.path.join(input_dir, filenames[name]), os.path.join(reference, filenames[name])]
+    return {'version': MANIFEST_VERSION,
+            'task': name,
+            'module': modules[name],
+            'arguments': inputs,
+            'inputs': {path: file_hash(path) for path in inputs},
+            'sources': {os.path.basename(path): file_hash(path) for path in module_sources(modules[name])},
+            }
+
+
+def is_up_to_date(name, manifest, output):
+    """
+    Whether the task already ran with the same manifest and its outputs are
+    still there
+    """
+    path = os.path.join(output, name, 'manifest.yaml')
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        previous = yaml.load(f, Loader=yaml.FullLoader) or {}
+    outputs = previous.pop('outputs', [])
+    return previous == manifest and all(os.path.exists(os.path.join(output, name, f)) for f in outputs)
+
+
+def run_task(name, reference, output, input_dir, workdir, manifest=None, jobs=None):
+    """
+    Run one of the plotting modules in its own working directory, so that
+    tasks running at the same time don't mix their plots, with at most jobs
+    processes for the modules that draw in parallel, and move its plots
+    to the output folder, together with the manifest of the task and the list
+    of its outputs. What the task prints goes to task.log in workdir.
+    Returns whether it succeeded
+    """
+    with open(os.path.join(workdir, 'task.log'), 'w') as log, contextlib.redirect_stdout(log):
+        try:
+            os.chdir(workdir)
+            logging.debug(f'Running "{name}" with file "{filenames[name]}"')
+            # Modules are imported only when they run, so that their imports
+            # are not paid by the tasks that are not requested
+            function = importlib.import_module(modules[name]).main
+            kwargs = {}
+            # The plots already drawn are kept next to the inputs, not in
+            # the temporary working directory
+            if 'render_cache' in inspect.signature(function).parameters:
+                kwargs['render_cache'] = os.path.join(input_dir, '.render_cache')
+            if jobs is not None and 'jobs' in inspect.signature(function).parameters:
+                kwargs['jobs'] = jobs
+            function(os.path.join(input_dir, filenames[name]), os.path.join(reference, filenames[name]), **kwargs)
+            # Move all svg files to the corresponding folder
+            os.makedirs(os.path.join(output, name, 'plots'), exist_ok=True)
+            outputs = []
+            for f in os.listdir('.'):
+                if f.endswith('.svg'):
+                    shutil.move(f, os.path.join(output, name, 'plots', f))
+                    outputs.append(os.path.join('plots', f))
+            # The status table with the results of the statistical tests
+            if os.path.exists('status.yaml'):
+                shutil.move('status.yaml', os.path.join(output, name, 'status.yaml'))
+                outputs.append('status.yaml')
+            if manifest is not None:
+                with open(os.path.join(output, name, 'manifest.yaml'), 'w') as f:
+                    yaml.dump(dict(manifest, outputs=sorted(outputs)), f)
+        except Exception as e:
+            print('Failed to run:', name, e)
+            return False
+    return True
+
+
+def _run_task_process(name, reference, output, input_dir, workdir, manifest, jobs):
+    # In its own process group, so that the processes it starts are stopped
+    # with it on timeout
+    os.setpgid(0, 0)
+    start = time.monotonic()
+    success = run_task(name, reference, output, input_dir, workdir, manifest, jobs)
+    # The resources used by the task are passed to the runner with a file
+    inputs = [os.path.join(input_dir, filenames[name]), os.path.join(reference, filenames[name])]
+    with open(os.path.join(workdir, 'usage.yaml'), 'w') as f:
+        yaml.dump(resource_usage.own_usage(start, inputs), f)
+    sys.exit(0 if success else 1)
+
+
+def add_dependencies(names):
+    """
+    Add the tasks that the given ones depend on, directly or not
+    """
+    names = list(names)
+    for name in names:
+        for dependency in dependencies.get(name, []):
+            if dependency not in names:
+                names.append(dependency)
+    return names
+
+
+def run_tasks(names, reference, output, jobs=None, timeout=None, force=False):
+    """
+    Run the tasks and the ones they depend on, each in its own process and
+    temporary working directory, up to jobs at the same time (by default as
+    many as cores), the cores being shared between the tasks that draw
+    their plots in parallel. A task starts when all its dependencies have finished
+    successfully and is stopped if it takes more than timeout seconds. Tasks
+    whose inputs, code and arguments did not change since they last ran are
+    skipped and their outputs reused, unless force is set. The resources
+    used by each task are recorded in the metadata.yaml of the output.
+    Returns the names of the tasks that failed or could not run
+    """
+    reference, output = os.path.abspath(reference), os.path.abspath(output)
+    input_dir = os.getcwd()
+    jobs = jobs or os.cpu_count() or 1
+    # Tasks running at the same time don't start more processes than cores
+    task_jobs = max(1, (os.cpu_count() or 1) // jobs)
+    pending = add_dependencies(names)
+    running = {}
+    done = set()
+    failed = []
+    while pending or running:
+        n_pending = len(pending)
+        for name in list(pending):
+            deps = dependencies.get(name, [])
+            if any(dep in failed for dep in deps):
+                print(f'Not running {name}, its dependencies failed')
+                pending.remove(name)
+                failed.append(name)
+            elif all(dep in done for dep in deps) and len(running) < jobs:
+                pending.remove(name)
+                try:
+                    manifest = task_manifest(name, reference, input_dir)
+                except OSError as e:
+                    print('Failed to run:', name, e)
+                    failed.append(name)
+                    continue
+                if not force and is_up_to_date(name, manifest, output):
+                    print(f'Skipping {name}, nothing changed since it last ran')
+                    done.add(name)
+                    continue
+                workdir = tempfile.mkdtemp(prefix=f'plot_runner_{name}_')
+                process = multiprocessing.Process(target=_run_task_process,
+                                                  args=(name, reference, output, input_dir, workdir, manifest, task_jobs))
+                process.start()
+                running[name] = (process, workdir, time.monotonic())
+        if not running:
+            # Tasks that were skipped or failed may let others start
+            if pending and len(pending) < n_pending:
+                continue
+            if pending:
+                print(f'Not running {pending}, their dependencies can not be satisfied')
+                failed.extend(pending)
+            break
+
+        multiprocessing.connection.wait([process.sentinel for process, _, _ in running.values()], timeout=1)
+        for name, (process, workdir, start) in list(running.items()):
+            if not process.is_alive():
+                process.join()
+                success = process.exitcode == 0
+            elif timeout is not None and time.monotonic() - start > timeout:
+                # Also stops the processes the task started
+                with contextlib.suppress(ProcessLookupError):
+                    os.killpg(process.pid, signal.SIGKILL)
+                process.join()
+                print(f'Failed to run: {name} took more than {timeout} s')
+                success = False
+            else:
+                continue
+            with open(os.path.join(workdir, 'task.log')) as log:
+                print(log.read(), end='')
+            usage = {'wall_time_s': round(time.monotonic() - start, 3)}
+            if os.path.exists(os.path.join(workdir, 'usage.yaml')):
+                with open(os.path.join(workdir, 'usage.yaml')) as f:
+                    usage = yaml.load(f, Loader=yaml.FullLoader)
+            usage['success'] = success
+            resource_usage.record(os.path.join(output, 'metadata.yaml'), name, usage)
+            shutil.rmtree(workdir)
+            del running[name]
+            if success:
+                done.add(name)
+            else:
+                failed.append(name)
+    return failed
+
+
+# Hashes of the sources of the local modules imported by the worker, the
+# code that it runs
+imported_sources = {}
 
-to_run = []
-for k, module in modules.items():
-    if k in args.plots:
-        imported = importlib.import_module(module)
-        to_run.append({'name': k, 'function': imported.main})
-        if args.debug:
-            logging.debug(f'Will run "{k}" with "{module}"')
-        args.plots.remove(k)
-if args.plots:
-    print(f'The following arguments were not recognized: {args.plots}')
 
+def local_modules():
+    """
+    Modules imported from files next to this one, by name
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    return {name: module for name, module in list(sys.modules.items())
+            if getattr(module, '__spec__', None) is not None and getattr(module, '__file__', None)
+            and module.__spec__.name == name and os.path.dirname(os.path.abspath(module.__file__)) == here}
 
-for run in to_run:
+
+def record_imported_sources():
+    imported_sources.clear()
+    for module in local_modules().values():
+        path = os.path.abspath(module.__file__)
+        if path.endswith('.py'):
+            imported_sources[path] = file_hash(path)
+
+
+def reload_changed_modules():
+    """
+    Reload the local modules whose source changed since the worker imported
+    them, and the ones that import them, so that the worker runs the code
+    that task_manifest records. Returns the names of the reloaded modules
+    """
+    changed = {path for path, h in imported_sources.items()
+               if not os.path.exists(path) or file_hash(path) != h}
+    if not changed:
+        return []
+    loaded = local_modules()
+    sources = {name: module_sources(name) for name in loaded}
+    stale = [name for name in loaded if changed & set(sources[name])]
+    # Modules depend only on modules with fewer sources, those are reloaded
+    # first so that the names imported from them are the new ones
+    stale.sort(key=lambda name: len(sources[name]))
+    for name in stale:
+        importlib.reload(loaded[name])
+    record_imported_sources()
+    return stale
+
+
+def warm_up():
+    """
+    Import all the plotting modules and set up matplotlib (fonts, canvas) so
+    that the jobs sent to the worker don't pay for it
+    """
+    for module in modules.values():
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            print(f'Failed to import {module}:', e)
+    record_imported_sources()
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure()
+    ax = fig.add_subplot(1, 1, 1)
+    ax.set_xlabel('$p_T$ [GeV]')
+    FigureCanvasAgg(fig).draw()
+
+
+def serve(socket_path):
+    """
+    Persistent worker: keeps the plotting modules imported and runs the jobs
+    sent by clients on a Unix socket, one at a time since each job runs in
+    its own working directory. A job is a line of JSON with plots,
+    reference, output and cwd; the answer is a line of JSON with the tasks
+    that failed and the output of the job
+    """
+    import io
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            job = json.loads(self.rfile.readline())
+            if job.get('shutdown'):
+                self.wfile.write(json.dumps({'failed': [], 'log': 'Worker stopped\n'}).encode() + b'\n')
+                self.server.stop = True
+                return
+            log = io.StringIO()
+            cwd = os.getcwd()
+            failed = job['plots']
+            try:
+                with contextlib.redirect_stdout(log):
+                    # The manifests are made from the sources on disk, the
+                    # code run has to be the same
+                    for name in reload_changed_modules():
+                        print(f'Reloaded {name}, its source changed')
+                    os.chdir(job['cwd'])
+                    failed = run_tasks(job['plots'], job['reference'], job['output'], job.get('jobs'), job.get('timeout'), job.get('force', False))
+            except Exception as e:
+                log.write(f'Failed to run the job: {e}\n')
+            finally:
+                os.chdir(cwd)
+            self.wfile.write(json.dumps({'failed': failed, 'log': log.getvalue()}).encode() + b'\n')
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    warm_up()
+    with socketserver.UnixStreamServer(socket_path, Handler) as server:
+        server.stop = False
+        logging.info(f'Worker listening on {socket_path}')
+        try:
+            while not server.stop:
+                server.handle_request()
+        finally:
+            os.remove(socket_path)
+
+
+def submit(socket_path, job):
+    """
+    Send a job to a worker started with --serve and wait for it to finish.
+    Returns the answer of the worker or None if no worker is listening
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
-        logging.debug(f'Running "{run["name"]}" with file "{filenames[run["name"]]}"')
-        run['function'](filenames[run['name']], os.path.join(args.reference, filenames[run['name']]))
-        # Move all png files to the corresponding folder
-        os.makedirs(os.path.join(args.output, run['name'], 'plots'), exist_ok=True)
-        for f in os.listdir('.'):
-            if f.endswith('.svg'):
-                shutil.move(f, os.path.join(args.output, run['name'], 'plots', f))
-
-    except Exception as e:
-        print('Failed to run:', run['name'], e)
+        client.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    with client, client.makefile('rwb') as stream:
+        stream.write(json.dumps(job).encode() + b'\n')
+        stream.flush()
+        return json.loads(stream.readline())
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('plots', nargs='*')
+    arg_parser.add_argument('--reference')
+    arg_parser.add_argument('--output')
+    arg_parser.add_argument('--debug', action='store_true')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of tasks running at the same time (default: number of cores)')
+    arg_parser.add_argument('--force', action='store_true', help='Run the tasks even if nothing changed since they last ran')
+    arg_parser.add_argument('--timeout', type=float, default=None, help='Stop the tasks that take more than this number of seconds')
+    arg_parser.add_argument('--serve', metavar='SOCKET', help='Start a persistent worker listening on this Unix socket')
+    arg_parser.add_argument('--socket', help='Send the job to the worker listening on this Unix socket, '
+                            'runs it in this process if there is no worker')
+    arg_parser.add_argument('--stop', action='store_true', help='Stop the worker listening on --socket')
+    args = arg_parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    if args.serve:
+        serve(args.serve)
+        return
+    if args.stop:
+        if not args.socket or submit(args.socket, {'shutdown': True}) is None:
+            print('No worker to stop')
+        return
+    if not args.plots or args.reference is None or args.output is None:
+        arg_parser.error('the plots and --reference and --output are required')
+
+    to_run = []
+    for k, module in modules.items():
+        if k in args.plots:
+            to_run.append(k)
+            if args.debug:
+                logging.debug(f'Will run "{k}" with "{module}"')
+            args.plots.remove(k)
+    if args.plots:
+        print(f'The following arguments were not recognized: {args.plots}')
+
+    if args.socket:
+        job = {'plots': to_run,
+               'reference': os.path.abspath(args.reference),
+               'output': os.path.abspath(args.output),
+               'cwd': os.getcwd(),
+               'jobs': args.jobs,
+               'timeout': args.timeout,
+               'force': args.force}
+        answer = submit(args.socket, job)
+        if answer is not None:
+            print(answer['log'], end='')
+            return
+        print(f'No worker listening on {args.socket}, running the plots here')
+
+    run_tasks(to_run, args.reference, args.output, args.jobs, args.timeout, args.force)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Resources used by the validation tasks (wall time, CPU time, peak RSS, size
+of the input files and all the bytes read by the process), recorded in the
+metadata.yaml of the version so that they show up in the web pages.
+
+plot_runner and the FCCee make_hists scripts measure themselves. Other steps
+can be run through this script, which measures the command it runs:
+    python resource_usage.py --metadata <version>/metadata.yaml --task ddsim \
+        --input steering.py -- ddsim --steeringFile steering.py ...
+"""
+import argparse
+import fcntl
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import yaml
+
+# Key of metadata.yaml under which the resources of each task are stored
+METADATA_KEY = 'resources'
+
+
+def bytes_read(pid='self'):
+    """
+    All the bytes read by a process, not only from its input files but also
+    from libraries, fonts, configuration, pipes... and including reads served
+    from the page cache, or None where /proc is not available
+    """
+    try:
+        with open(f'/proc/{pid}/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def input_bytes(inputs):
+    """
+    Total size of the input files of a task, the ones that do not exist are
+    skipped
+    """
+    return sum(os.path.getsize(path) for path in inputs if os.path.exists(path))
+
+
+def _usage(wall, cpu, max_rss_kb, read, inputs):
+    usage = {'wall_time_s': round(wall, 3),
+             'cpu_time_s': round(cpu, 3),
+             'peak_rss_mb': round(max_rss_kb / 1024, 1),
+             'process_bytes_read': read,
+             }
+    if inputs:
+        usage['input_bytes'] = input_bytes(inputs)
+    return usage
+
+
+def own_usage(start, inputs=()):
+    """
+    Resources used by this process and its finished children, with start
+    the value of time.monotonic() when the task started and inputs the input
+    files of the task. To be called at the end of a task running in its own
+    process
+    """
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = sum(u.ru_utime + u.ru_stime for u in [usage_self, usage_children])
+    return _usage(time.monotonic() - start, cpu,
+                  max(usage_self.ru_maxrss, usage_children.ru_maxrss), bytes_read(), inputs)
+
+
+def run_command(command, inputs=()):
+    """
+    Run a command with the given input files and measure the resources it
+    uses, returns its exit code and the resources
+    """
+    start = time.monotonic()
+    process = subprocess.Popen(command)
+    read = None
+    # /proc/<pid>/io is only there while the process exists, it is sampled
+    # until the process has exited but has not been waited for yet
+    while True:
+        read = bytes_read(process.pid) or read
+        if os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None:
+            read = bytes_read(process.pid) or read
+            break
+        time.sleep(0.1)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, _usage(time.monotonic() - start, usage.ru_utime + usage.ru_stime,
+                                      usage.ru_maxrss, read, inputs)
+
+
+def record(metadata_file, task, usage):
+    """
+    Add the resources used by a task to metadata.yaml. The file is locked
+    while it is updated, since several tasks can finish at the same time
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(metadata_file)), exist_ok=True)
+    with open(metadata_file, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        metadata = yaml.load(f, Loader=yaml.FullLoader) or {}
+        metadata.setdefault(METADATA_KEY, {})[task] = usage
+        f.seek(0)
+        f.truncate()
+        yaml.dump(metadata, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a command and record the resources it uses in metadata.yaml')
+    parser.add_argument('--metadata', required=True, help='Path to the metadata.yaml of the version')
+    parser.add_argument('--task', required=True, help='Name of the task in the metadata')
+    parser.add_argument('--input', action='append', default=[], help='Input file of the command, can be given several times')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='Command to run, after --')
+    args = parser.parse_args()
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        parser.error('no command given')
+
+    returncode, usage = run_command(command, args.input)
+    record(args.metadata, args.task, dict(usage, exit_code=returncode))
+    sys.exit(returncode)
+
+
+if __name__ == '__main__':
+    main()
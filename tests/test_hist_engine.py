@@ -0,0 +1,136 @@
+# Test the reading of the columns of the FCCee histogram engine on a small
+# file written with uproot, with podio-like branch names. ROOT is not needed
+
+import os
+import sys
+
+import awkward as ak
+import numpy as np
+import pytest
+import uproot
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'FCCee', 'utils'))
+
+import hist_engine  # noqa: E402
+
+# Hits of each event, with the index of their MC particle (-1 for none)
+HITS_PARTICLE = [[0, 1, -1, 0], [], [0], [1, 1]]
+HITS_EDEP = [[1., 2., 3., 4.], [], [5.], [6., 7.]]
+# Stored as float, summing in float would lose the 1
+HITS_TIME = [[1e8, 1., -1e8, 0.], [], [5.], [6., 7.]]
+PARTICLES_PDG = [[22, 11], [22], [11], [13, -22]]
+PARTICLES_MOMENTUM = [[(0., 1., 0.), (1., 0., 1.)], [(0., 0., 1.)], [(1., 1., 0.)], [(0., 0., -1.), (1., 0., 0.)]]
+
+
+@pytest.fixture
+def events(tmp_path):
+    filename = str(tmp_path / 'events.root')
+    branches = {'ArcCollection.eDep': ak.Array(HITS_EDEP),
+                '_ArcCollection_particle.index': ak.values_astype(ak.Array(HITS_PARTICLE), np.int32),
+                'ArcCollection.time': ak.values_astype(ak.Array(HITS_TIME), np.float32),
+                'MCParticles.PDG': ak.values_astype(ak.Array(PARTICLES_PDG), np.int32),
+                'EventHeader.eventNumber': ak.values_astype(ak.Array([0, 1, 2, 3]), np.int32),
+                }
+    for i, c in enumerate('xyz'):
+        branches[f'MCParticles.momentum.{c}'] = ak.Array([[p[i] for p in event] for event in PARTICLES_MOMENTUM])
+    with uproot.recreate(filename) as f:
+        f.mktree('events', {k: v.type.content for k, v in branches.items()})
+        # Two extends make two baskets
+        f['events'].extend({k: v[:2] for k, v in branches.items()})
+        f['events'].extend({k: v[2:] for k, v in branches.items()})
+    return filename
+
+
+def evaluate(filename, quantity):
+    tree = uproot.open(filename)['events']
+    branches, values = hist_engine.Columns(tree).quantity(quantity)
+    return values(tree.arrays(branches, library='ak'))
+
+
+def test_branch_sizes(events):
+    tree = uproot.open(events)['events']
+    branch = tree['ArcCollection.eDep']
+    assert branch.num_baskets == 2
+    expected = [len(hits) for hits in HITS_EDEP]
+    assert hist_engine.branch_sizes(branch).tolist() == expected
+    assert hist_engine.branch_sizes(branch, 1, 3).tolist() == expected[1:3]
+    sizes = hist_engine.multiplicities(tree, ['ArcCollection', 'MCParticles'])
+    assert sizes['MCParticles'].tolist() == [len(p) for p in PARTICLES_PDG]
+    with pytest.raises(ValueError, match='not a jagged branch'):
+        hist_engine.branch_sizes(tree['EventHeader.eventNumber'])
+
+
+def test_branch_sizes_without_offsets(events, monkeypatch):
+    # Baskets without entry offsets take the sizes from the count branch
+    monkeypatch.setattr(uproot.models.TBasket.Model_TBasket, 'byte_offsets', property(lambda self: None))
+    branch = uproot.open(events)['events']['ArcCollection.eDep']
+    assert hist_engine.branch_sizes(branch).tolist() == [len(hits) for hits in HITS_EDEP]
+
+
+def test_hit_and_sum(events):
+    quantity = {'collection': 'ArcCollection', 'expression': 'eDep'}
+    assert evaluate(events, quantity).tolist() == [1., 2., 3., 4., 5., 6., 7.]
+    quantity['reduction'] = 'sum'
+    assert evaluate(events, quantity).tolist() == [10., 0., 5., 13.]
+    quantity['expression'] = 'time'
+    values = evaluate(events, quantity)
+    assert values.dtype == np.float64
+    assert values.tolist() == [1., 0., 5., 13.]
+
+
+def test_relation(events):
+    # Hits without a particle are skipped
+    quantity = {'collection': 'ArcCollection', 'expression': 'particle.PDG'}
+    assert evaluate(events, quantity).tolist() == [22, 11, 22, 11, -22, -22]
+
+
+def test_select(events):
+    quantity = {'collection': 'ArcCollection', 'reduction': 'count',
+                'select': {'expression': 'particle.PDG', 'values': [22, -22]}}
+    assert evaluate(events, quantity).tolist() == [2, 0, 0, 2]
+    quantity['expression'] = 'eDep'
+    quantity['reduction'] = 'hit'
+    assert evaluate(events, quantity).tolist() == [1., 4., 6., 7.]
+
+
+def test_first_and_vector_function(events):
+    quantity = {'collection': 'MCParticles', 'expression': 'theta(momentum)', 'reduction': 'first'}
+    values = evaluate(events, quantity)
+    assert np.allclose(ak.to_numpy(values), [np.pi / 2, 0., np.pi / 2, np.pi])
+
+
+def test_weight(events):
+    # One weight per event, aligned with the first particle of the event
+    values = evaluate(events, {'collection': 'MCParticles', 'expression': 'PDG', 'reduction': 'first'})
+    weights = evaluate(events, {'collection': 'ArcCollection', 'reduction': 'count'})
+    assert ak.to_list(values) == [22, 22, 11, 13]
+    assert weights.tolist() == [4, 0, 1, 2]
+
+
+def test_load_spec(tmp_path):
+    spec_file = tmp_path / 'spec.yaml'
+    spec_file.write_text('ARC:\n'
+                         '  - name: h\n'
+                         '    title: "t"\n'
+                         '    bins: [10, 0, 1]\n'
+                         '    collection: ArcCollection\n'
+                         '    reduction: count\n')
+    assert hist_engine.load_spec(spec_file)['ARC'][0]['name'] == 'h'
+
+    spec_file.write_text('ARC:\n  - name: h\n    title: "t"\n    bins: [10, 0]\n    collection: C\n')
+    with pytest.raises(ValueError, match='bins'):
+        hist_engine.load_spec(spec_file)
+
+    spec_file.write_text('ARC:\n  - name: h\n    title: "t"\n    bins: [10, 0, 1]\n')
+    with pytest.raises(ValueError, match='collection'):
+        hist_engine.load_spec(spec_file)
+
+    spec_file.write_text('ARC:\n  - name: h\n    title: "t"\n    bins: [10, 0, 1]\n    collection: C\n    reduction: max\n')
+    with pytest.raises(ValueError, match='Unknown reduction'):
+        hist_engine.load_spec(spec_file)
+
+    # Weights are given per event
+    spec_file.write_text('ARC:\n  - name: h\n    title: "t"\n    bins: [10, 0, 1]\n    collection: C\n'
+                         '    weight: {collection: C, reduction: count}\n')
+    with pytest.raises(ValueError, match='per-event'):
+        hist_engine.load_spec(spec_file)
@@ -0,0 +1,93 @@
+# Test the statistical comparison of current and reference histograms
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import histogram_tests  # noqa: E402
+from matplotlib_utils import make_histogram  # noqa: E402
+
+EDGES = np.linspace(-5, 5, 51)
+
+
+def sample(shift=0., n=20000, seed=1):
+    return make_histogram(np.random.default_rng(seed).normal(shift, 1, n), EDGES)
+
+
+def test_identical():
+    hist = sample()
+    results = histogram_tests.compare([hist], [hist])
+    assert results['chi2'][0] == 0
+    assert results['chi2_p_value'][0] > 0.99
+    assert results['ks_p_value'][0] == 1
+    assert results['mean_shift'][0] == 0
+    table = histogram_tests.status_table(['h'], [hist], [hist])
+    assert table[0]['status'] == 'ok' and table[0]['failed'] == []
+
+
+def test_same_distribution():
+    # Independent samples of the same distribution pass
+    table = histogram_tests.status_table(['h'], [sample(seed=1)], [sample(seed=2)])
+    assert table[0]['status'] == 'ok'
+
+
+def test_shifted():
+    table = histogram_tests.status_table(['ok', 'shifted'], [sample(seed=1), sample(0.2, seed=1)],
+                                         [sample(seed=2), sample(seed=2)])
+    # Failing histograms come first
+    assert [row['name'] for row in table] == ['shifted', 'ok']
+    assert table[0]['status'] == 'fail'
+    assert {'chi2', 'ks', 'mean'} <= set(table[0]['failed'])
+    assert table[1]['status'] == 'ok'
+
+
+def test_nearly_identical():
+    # One extra entry in ten million is far from significant
+    reference = sample()
+    reference = dict(reference, counts=reference['counts'] * 500, entries=reference['entries'] * 500)
+    current = dict(reference, counts=reference['counts'].copy(), entries=reference['entries'] + 1)
+    current['counts'][20] += 1
+    results = histogram_tests.compare([current], [reference])
+    assert 0 < results['ks'][0] < 1e-6
+    assert results['ks_p_value'][0] == pytest.approx(1)
+    table = histogram_tests.status_table(['h'], [current], [reference])
+    assert table[0]['status'] == 'ok'
+    assert histogram_tests.ks_p_value(1e-4, 1.) == 1
+
+
+def test_empty_bins():
+    # Bins empty in both histograms don't count in the degrees of freedom
+    current = {'counts': np.array([0, 10, 20, 0, 0]), 'mean': 1.6, 'std': 0.5, 'entries': 30}
+    reference = {'counts': np.array([0, 10, 20, 0, 0]), 'mean': 1.6, 'std': 0.5, 'entries': 30}
+    results = histogram_tests.compare([current], [reference])
+    assert results['ndf'][0] == 1
+    assert results['chi2'][0] == 0
+
+    # Empty histograms are not compared, they don't fail
+    empty = {'counts': np.zeros(5), 'mean': 0., 'std': 0., 'entries': 0}
+    results = histogram_tests.compare([empty], [reference])
+    assert results['ndf'][0] == 0
+    assert results['chi2_p_value'][0] == 1 and results['ks_p_value'][0] == 1
+
+
+def test_different_binning():
+    # Shorter histograms are padded with empty bins
+    short = {'counts': np.array([10, 20]), 'mean': 0.7, 'std': 0.5, 'entries': 30}
+    long = {'counts': np.array([10, 20, 0, 0]), 'mean': 0.7, 'std': 0.5, 'entries': 30}
+    results = histogram_tests.compare([short], [long])
+    assert results['chi2'][0] == 0 and results['ks'][0] == 0
+
+
+def test_check_plots(tmp_path):
+    plots = [{'filename': 'a.png', 'current': sample(0.2, seed=1), 'reference': sample(seed=2)},
+             {'filename': 'b.png', 'current': sample(seed=1), 'reference': sample(seed=2)},
+             {'filename': 'c.png', 'current': sample(seed=1)},
+             ]
+    status = tmp_path / 'status.yaml'
+    table = histogram_tests.check_plots(plots, str(status))
+    assert [plot.get('alert') for plot in plots] == [True, False, None]
+    assert len(table) == 2 and status.exists()
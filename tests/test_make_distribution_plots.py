@@ -0,0 +1,97 @@
+# Test how the entries of the distribution validation are booked, in
+# particular the ones with a function compiled to C++
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from make_distribution_plots import Validator  # noqa: E402
+
+
+class FakeCache:
+    """
+    Records what is booked instead of creating RDataFrame actions. Defined
+    columns get a different name in each node, like in DataCache
+    """
+    def __init__(self, compiles=True):
+        self.compiles = compiles
+        self.nodes = {}
+        self.booked = []
+
+    def node(self, filenames, filt=None):
+        return (filenames, filt)
+
+    def define(self, node, func, columns):
+        if not self.compiles:
+            return None
+        key = node + (func.text, tuple(columns))
+        self.nodes.setdefault(key, f'expr_{len(self.nodes)}')
+        return key, self.nodes[key]
+
+    def book(self, node, action, var, *args):
+        self.booked.append((node, action, var))
+
+
+def make_conf(var, function):
+    return {'entry': {'var': var, 'function': function, 'filename': 'new.root', 'reference': 'ref.root'}}
+
+
+def test_compiled_single_column():
+    cache = FakeCache()
+    booked = Validator(make_conf('MCParticles.mass', 'lambda x: x**2')).book(cache, ['entry'])
+    entry = booked['entry']
+    # The histograms are filled with the defined columns, not the raw one
+    assert entry['func'] is None
+    assert set(entry['var'].values()) == {'expr_0', 'expr_1'}
+    assert entry['var']['new'] != entry['var']['ref']
+    for k, node in entry['samples'].items():
+        assert (node, 'Min', entry['var'][k]) in cache.booked
+        assert (node, 'Max', entry['var'][k]) in cache.booked
+    assert not any(var == 'MCParticles.mass' for _, _, var in cache.booked)
+
+
+def test_compiled_multiple_columns():
+    cache = FakeCache()
+    conf = make_conf(['MCParticles.momentum.x', 'MCParticles.momentum.y'], 'lambda x, y: x**2 + y**2')
+    booked = Validator(conf).book(cache, ['entry'])
+    entry = booked['entry']
+    # Filled in the event loop, without reading the columns
+    assert 'columns' not in entry
+    assert entry['var']['new'] != entry['var']['ref']
+    assert not any(action == 'Take' for _, action, _ in cache.booked)
+
+
+def test_not_compiled_function():
+    cache = FakeCache(compiles=False)
+    conf = make_conf(['MCParticles.momentum.x', 'MCParticles.momentum.y'], 'lambda x, y: x**2 + y**2')
+    entry = Validator(conf).book(cache, ['entry'])['entry']
+    # Evaluated with numpy on the columns
+    assert entry['func'] is not None
+    assert entry['columns'] == conf['entry']['var']
+    assert np.allclose(entry['func'](np.array([3.]), np.array([4.])), [25.])
+    assert sum(action == 'Take' for _, action, _ in cache.booked) == 4
+
+
+def test_compute_results(tmp_path):
+    ROOT = pytest.importorskip('ROOT')
+    filename = str(tmp_path / 'events.root')
+    values = np.array([1., 2., 3., 4.])
+    df = ROOT.RDataFrame(len(values)).Define('x', 'double(rdfentry_ + 1)').Define('y', 'double(2 * rdfentry_)')
+    df.Snapshot('events', filename)
+
+    conf = {'single': {'var': 'x', 'function': 'lambda x: x**2', 'filename': filename, 'bins': 4, 'range': [0, 20]},
+            'multiple': {'var': ['x', 'y'], 'function': 'lambda x, y: x + y', 'filename': filename, 'bins': 4, 'range': [0, 20]},
+            }
+    validator = Validator(conf, cache_dir=None, threads=1)
+    results = validator.compute_results(list(conf))
+    counts, edges, mean, _, entries = results['single']['new']
+    assert np.array_equal(counts, np.histogram(values**2, bins=edges)[0])
+    assert mean == pytest.approx(np.mean(values**2))
+    counts, edges, mean, _, entries = results['multiple']['new']
+    y = 2 * (values - 1)
+    assert np.array_equal(counts, np.histogram(values + y, bins=edges)[0])
+    assert entries == len(values)
@@ -0,0 +1,25 @@
+# Test the render cache of the histogram plots
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from matplotlib_utils import draw_hist_plots, make_histogram  # noqa: E402
+
+
+def test_render_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    hist = make_histogram(np.random.default_rng(1).normal(0, 1, 1000), np.linspace(-5, 5, 51))
+    plots = [{'filename': 'a.png', 'current': hist}]
+    draw_hist_plots(plots, jobs=1)
+    cached = os.listdir('.render_cache')
+    assert len(cached) == 1
+
+    # The second time the plot is already a link to the cached file
+    draw_hist_plots(plots, jobs=1)
+    assert os.listdir('.render_cache') == cached
+    assert os.path.samefile('a.png', os.path.join('.render_cache', cached[0]))
+    assert not list(tmp_path.rglob('*.tmp'))
@@ -21,6 +21,22 @@ for k, v in {'track_validation': 'Track Validation',
              'distributions': 'Distributions',}.items():
     FOLDER_NAMES[k] = v
 
+def format_usage(usage):
+    parts = []
+    if 'wall_time_s' in usage:
+        parts.append(f"wall {usage['wall_time_s']:.1f} s")
+    if 'cpu_time_s' in usage:
+        parts.append(f"CPU {usage['cpu_time_s']:.1f} s")
+    if 'peak_rss_mb' in usage:
+        parts.append(f"peak RSS {usage['peak_rss_mb']:.0f} MB")
+    if usage.get('input_bytes') is not None:
+        parts.append(f"input {usage['input_bytes'] / 1024**2:.1f} MB")
+    if usage.get('process_bytes_read') is not None:
+        parts.append(f"total process reads {usage['process_bytes_read'] / 1024**2:.1f} MB")
+    if usage.get('success') is False or usage.get('exit_code', 0) != 0:
+        parts.append('failed')
+    return ', '.join(parts)
+
 def get_metadata(folder_path):
     metadata = {}
     file = os.path.join(folder_path, 'metadata.yaml')
@@ -31,9 +47,13 @@ def get_metadata(folder_path):
         metadata['key4hep-spack'] = [metadata['key4hep-spack'], f"https://github.com/key4hep/key4hep-spack/commit/{metadata['key4hep-spack']}"]
     if 'spack' in metadata:
         metadata['spack'] = [metadata['spack'], f"https://github.com/spack/spack/commit/{metadata['spack']}"]
+    # Resources used by each task, see scripts/resource_usage.py
+    resources = metadata.pop('resources', None) or {}
     for k, v in metadata.items():
         if isinstance(v, str) or len(v) == 1:
             metadata[k] = [v, None]
+    for task, usage in resources.items():
+        metadata[f'Resources: {task}'] = [format_usage(usage), None]
     print(metadata)
     return metadata
 
@@ -54,17 +74,59 @@ def get_latest_modified_date(folder_path):
     latest_modified_date = datetime.datetime.fromtimestamp(int(latest_modified_date))
     return latest_modified_date
 
+def get_status(folder):
+    # Status table with the results of the statistical tests, sorted from the
+    # worst to the best agreement
+    file = os.path.join(folder, 'status.yaml')
+    if not os.path.exists(file):
+        return []
+    with open(file) as f:
+        return yaml.load(f, Loader=yaml.FullLoader) or []
+
 def write_plots(folder):
     # Generate a list of the PNG images in the folder
     svg_files = [os.path.join('plots', filename) for filename in os.listdir(os.path.join(folder, 'plots')) if filename.endswith('.svg')]
     print(svg_files)
+    status = get_status(folder)
+    failed = {os.path.join('plots', row['name']) for row in status if row['status'] == 'fail'}
+    # Failing plots first
+    svg_files.sort(key=lambda filename: filename not in failed)
 
     # Generate the HTML markup using a Jinja2 template
     template = jinja2.Template('''
-    {% for filename in svg_files %} <img src="{{ filename }}" class="plot-container"/>
+    {% if status %}
+    <table class="table table-sm table-hover" id="status-table">
+      <thead><tr>
+        {% for column in columns %}<th onclick="sortTable({{ loop.index0 }})" style="cursor: pointer">{{ column }}</th>{% endfor %}
+      </tr></thead>
+      <tbody>
+      {% for row in status %}
+        <tr class="{{ 'table-danger' if row.status == 'fail' else '' }}">
+          <td><a href="#{{ row.name }}">{{ row.name }}</a></td><td>{{ row.status }}</td><td>{{ row.failed | join(', ') }}</td>
+          <td>{{ '%.3g' % row.p_value }}</td><td>{{ '%.3g' % row.chi2 }}/{{ row.ndf }}</td><td>{{ '%.3g' % row.chi2_p_value }}</td>
+          <td>{{ '%.3g' % row.ks }}</td><td>{{ '%.3g' % row.ks_p_value }}</td><td>{{ '%.3g' % row.mean_shift }}</td><td>{{ '%.3g' % row.width_shift }}</td>
+        </tr>
+      {% endfor %}
+      </tbody>
+    </table>
+    <script>
+      function sortTable(column) {
+        const body = document.querySelector('#status-table tbody');
+        const rows = Array.from(body.rows);
+        const key = row => { const text = row.cells[column].innerText; const value = parseFloat(text); return isNaN(value) ? text : value; };
+        const ascending = body.dataset.column != column || body.dataset.ascending != 'true';
+        rows.sort((a, b) => (key(a) > key(b) ? 1 : key(a) < key(b) ? -1 : 0) * (ascending ? 1 : -1));
+        rows.forEach(row => body.appendChild(row));
+        body.dataset.column = column;
+        body.dataset.ascending = ascending;
+      }
+    </script>
+    {% endif %}
+    {% for filename in svg_files %} <img src="{{ filename }}" id="{{ filename | replace('plots/', '') }}" class="plot-container"/>
     {% endfor %}
     ''')
-    html = template.render(svg_files=svg_files)
+    columns = ['Plot', 'Status', 'Failed tests', 'p-value', 'chi2/ndf', 'chi2 p-value', 'KS', 'KS p-value', 'Mean shift', 'Width shift']
+    html = template.render(svg_files=svg_files, status=status, columns=columns)
 
     return html
 